@@ -0,0 +1,214 @@
+"""IADS ENTITY SCANNER BATCH"""
+
+import contextlib
+import heapq
+import json
+import zlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path, PurePosixPath
+from typing import Iterator, Optional, TextIO
+
+from scanner import (
+    SCAN_JOBS,
+    build_entity_index,
+    get_manifest_record,
+    open_scan_cache,
+    scan_entity_files,
+    scan_work_packages,
+    update_work_packages,
+    walk_project,
+)
+
+# Status recorded for work packages that were only scanned
+SCANNED = "scanned"
+
+
+def parse_shard(text: str) -> tuple[int, int]:
+    """"""
+    index, _, count = text.partition("/")
+    try:
+        shard = (int(index), int(count))
+    except ValueError:
+        shard = (0, 0)
+    if not 1 <= shard[0] <= shard[1]:
+        raise ValueError(f"invalid shard {text!r}, expected k/N with 1 <= k <= N")
+    return shard
+
+
+def in_shard(path: Path, folder_path: Path, shard: tuple[int, int]) -> bool:
+    """"""
+    # The project-relative path gives every build node the same split, wherever it checks out
+    index, count = shard
+    key = path.relative_to(folder_path).as_posix().encode("utf-8")
+    return zlib.crc32(key) % count == index - 1
+
+
+def get_result_path(
+    output_dir: Path, folder_path: Path, shard: Optional[tuple[int, int]] = None
+) -> Path:
+    """"""
+    suffix = f".{shard[0]}-of-{shard[1]}" if shard else ""
+    return output_dir / f"{folder_path.name}{suffix}.jsonl"
+
+
+def run_project(
+    folder_path: Path,
+    result_path: Path,
+    shard: Optional[tuple[int, int]] = None,
+    update: bool = False,
+    dry_run: bool = False,
+    jobs: int = SCAN_JOBS,
+    use_cache: bool = True,
+) -> dict:
+    """"""
+    # All state lives in this call, so projects in one batch never see each other's entities
+    with contextlib.ExitStack() as stack:
+        cache = stack.enter_context(
+            open_scan_cache(folder_path) if use_cache else contextlib.nullcontext()
+        )
+        inventory = walk_project(folder_path)
+        entity_index = build_entity_index(scan_entity_files(inventory.entity_files, cache))
+        xml_files = [
+            path
+            for path in inventory.work_packages
+            if shard is None or in_shard(path, folder_path, shard)
+        ]
+
+        # A header line, one record per work package in path order, and a closing summary
+        results = stack.enter_context(result_path.open("w", encoding="utf-8"))
+        header = {"project": folder_path.name, "shard": list(shard or (1, 1))}
+        results.write(json.dumps(header) + "\n")
+
+        work_packages = (
+            work_package
+            for work_package in scan_work_packages(xml_files, cache, jobs)
+            if work_package.opening_tag is not None
+        )
+        if update:
+            statuses = update_work_packages(
+                list(work_packages), entity_index, cache, jobs, dry_run=dry_run
+            )
+        else:
+            statuses = ((SCANNED, work_package) for work_package in work_packages)
+
+        status_counts = Counter()
+        for status, work_package in statuses:
+            status_counts[status] += 1
+            if work_package is not None:
+                record = get_manifest_record(work_package, entity_index, folder_path)
+                record["status"] = status
+                results.write(json.dumps(record) + "\n")
+        results.write(json.dumps({"counts": status_counts}) + "\n")
+
+    return dict(header, counts=dict(status_counts), result=str(result_path))
+
+
+def run_batch(
+    folder_paths: list[Path],
+    output_dir: Path,
+    shard: Optional[tuple[int, int]] = None,
+    update: bool = False,
+    dry_run: bool = False,
+    jobs: int = SCAN_JOBS,
+    parallel: int = 1,
+    use_cache: bool = True,
+) -> Iterator[tuple[Path, Optional[dict], Optional[Exception]]]:
+    """"""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    arguments = {
+        folder_path: (
+            folder_path,
+            get_result_path(output_dir, folder_path, shard),
+            shard,
+            update,
+            dry_run,
+            jobs,
+            use_cache,
+        )
+        for folder_path in folder_paths
+    }
+
+    # One project needs no pool; several each get a process of their own
+    if parallel <= 1 or len(folder_paths) == 1:
+        for folder_path, project_arguments in arguments.items():
+            try:
+                yield folder_path, run_project(*project_arguments), None
+            except (OSError, UnicodeDecodeError) as error:
+                yield folder_path, None, error
+        return
+
+    with ProcessPoolExecutor(max_workers=parallel) as executor:
+        futures = {
+            executor.submit(run_project, *project_arguments): folder_path
+            for folder_path, project_arguments in arguments.items()
+        }
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except (OSError, UnicodeDecodeError) as error:
+                yield futures[future], None, error
+
+
+def merge_results(result_paths: list[Path], stream: TextIO) -> dict[str, Counter]:
+    """"""
+    # Check every shard is present and finished before writing anything
+    shards = {}
+    totals = {}
+    for result_path in result_paths:
+        header, status_counts = read_result_summary(result_path)
+        project, (index, count) = header["project"], header["shard"]
+        expected_count, indexes = shards.setdefault(project, (count, set()))
+        if count != expected_count:
+            raise ValueError(
+                f"{result_path}: {project} was split into {count} shards, not {expected_count}"
+            )
+        if index in indexes:
+            raise ValueError(f"{result_path}: shard {index}/{count} of {project} is repeated")
+        indexes.add(index)
+        totals.setdefault(project, Counter()).update(status_counts)
+
+    for project, (count, indexes) in shards.items():
+        missing = sorted(set(range(1, count + 1)) - indexes)
+        if missing:
+            raise ValueError(
+                f"{project} is missing shard {', '.join(map(str, missing))} of {count}"
+            )
+
+    # Every result file is already in path order, so merging them streams in path order too
+    with contextlib.ExitStack() as stack:
+        records = [
+            read_result_records(stack.enter_context(result_path.open("r", encoding="utf-8")))
+            for result_path in result_paths
+        ]
+        for record in heapq.merge(
+            *records, key=lambda record: (record["project"], PurePosixPath(record["path"]).parts)
+        ):
+            stream.write(json.dumps(record) + "\n")
+
+    return totals
+
+
+def read_result_summary(result_path: Path) -> tuple[dict, dict]:
+    """"""
+    header = summary = None
+    with result_path.open("r", encoding="utf-8") as results:
+        for line_number, line in enumerate(results):
+            if line_number == 0:
+                header = json.loads(line)
+            else:
+                summary = line
+    # A shard that died halfway has no closing summary
+    summary = json.loads(summary) if summary else {}
+    if not header or "shard" not in header or "counts" not in summary:
+        raise ValueError(f"{result_path} is not a complete batch result")
+    return header, summary["counts"]
+
+
+def read_result_records(results: TextIO) -> Iterator[dict]:
+    """"""
+    project = json.loads(next(results))["project"]
+    for line in results:
+        record = json.loads(line)
+        if "path" in record:
+            yield dict(record, project=project)
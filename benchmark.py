@@ -0,0 +1,257 @@
+"""IADS ENTITY SCANNER BENCHMARK"""
+
+import argparse
+import functools
+import json
+import random
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+from scanner import (
+    ENTITY_FILES,
+    GRAPHIC_TAGS,
+    SCAN_JOBS,
+    ScanCache,
+    build_entity_index,
+    read_work_package,
+    scan_entity_files,
+    scan_work_packages,
+    update_work_packages,
+    walk_project,
+)
+
+DEFAULT_SIZES = (100, 1_000, 10_000)
+# Reads kept in flight by the read-ahead phase
+DEFAULT_READ_AHEAD = 16
+# Declarations written to each generated entity file
+ENTITIES_PER_FILE = 2_000
+# Board numbers shared by the generated work packages
+GRAPHICS_POOL_SIZE = 5_000
+WORK_PACKAGE_TAGS = ("maintwp", "descwp", "opwp", "torqwp", "ctrlindicwp", "theorywp")
+
+
+def generate_project(
+    folder_path: Path,
+    work_packages: int,
+    entities_per_file: int = ENTITIES_PER_FILE,
+    seed: int = 0,
+) -> Path:
+    """"""
+    rng = random.Random(seed)
+    folder_path = Path(folder_path)
+
+    # Boilerplate entity files live under dtd/boilerplate, custom ones under entities
+    entity_names = []
+    for key, (_, filename, _) in ENTITY_FILES.items():
+        entity_path = folder_path / filename.removeprefix("../")
+        entity_path = entity_path.with_name(f"{key}.ent")
+        entity_path.parent.mkdir(parents=True, exist_ok=True)
+
+        names = [f"{key}.{number:05d}" for number in range(entities_per_file)]
+        with entity_path.open("w", encoding="utf-8") as entity_file:
+            entity_file.write(f"<!-- {key} entities -->\n")
+            for name in names:
+                # Some replacement texts reference an entity of an earlier file
+                reference = ""
+                if entity_names and rng.random() < 0.1:
+                    reference = f" &{rng.choice(entity_names)};"
+                entity_file.write(f'<!ENTITY {name} "Replacement text for {name}{reference}">\n')
+        entity_names.extend(names)
+
+    # Only half of the board numbers have an SVG; every one has a raster copy the walk can skip
+    graphics_path = folder_path / "graphics-SVG"
+    raster_path = folder_path / "graphics-PNG"
+    graphics_path.mkdir(parents=True, exist_ok=True)
+    raster_path.mkdir(parents=True, exist_ok=True)
+    boardnos = [f"BN{number:06d}" for number in range(GRAPHICS_POOL_SIZE)]
+    for index, boardno in enumerate(boardnos):
+        if index < GRAPHICS_POOL_SIZE // 2:
+            (graphics_path / f"{boardno}.svg").write_text("<svg/>\n", encoding="utf-8")
+        (raster_path / f"{boardno}.png").write_bytes(b"")
+
+    files_path = folder_path / "files"
+    files_path.mkdir(parents=True, exist_ok=True)
+    for number in range(work_packages):
+        write_work_package(files_path / f"wp{number:06d}.xml", rng, entity_names, boardnos, number)
+
+    return folder_path
+
+
+def write_work_package(
+    path: Path, rng: random.Random, entity_names: list, boardnos: list, number: int
+) -> None:
+    """"""
+    opening_tag = rng.choice(WORK_PACKAGE_TAGS)
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>']
+
+    # Half of the work packages already carry a DOCTYPE from an earlier update
+    if number % 2:
+        lines.append(f'<!DOCTYPE {opening_tag} PUBLIC "-//USA-DOD//DTD" "../dtd/40051D_7_0.dtd" [')
+        lines.append('\t<!ENTITY % isb PUBLIC "-//TRG//ENTITIES" "../entities/isb.ent"> %isb;')
+        lines.append("]>")
+
+    lines.append(f'<{opening_tag} chap-toc="no" wpno="WP{number:06d}">')
+    for _ in range(rng.randint(20, 200)):
+        kind = rng.random()
+        if kind < 0.1:
+            tag = rng.choice(GRAPHIC_TAGS)
+            # Some board numbers sit on the line after the element name
+            separator = "\n\t" if rng.random() < 0.2 else ""
+            lines.append(f'<figure>{tag}{separator}boardno="{rng.choice(boardnos)}"/></figure>')
+        elif kind < 0.5:
+            references = " ".join(f"&{rng.choice(entity_names)};" for _ in range(rng.randint(1, 4)))
+            lines.append(f"<para>Step text {references} with more words.</para>")
+        else:
+            lines.append("<para>Plain procedural text without references &amp; markup.</para>")
+    lines.append(f"</{opening_tag}>")
+
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+
+def run_benchmark(
+    folder_path: Path, jobs: int, repeat: int, latency: float = 0.0, read_ahead: int = 0
+) -> dict:
+    """"""
+    timings = {}
+
+    inventory = best_of(repeat, timings, "walk_project", walk_project, folder_path)
+    ext_entity_dict = best_of(
+        repeat, timings, "scan_entity_files", scan_entity_files, inventory.entity_files
+    )
+    entity_index = build_entity_index(ext_entity_dict)
+    xml_files = inventory.work_packages
+
+    work_packages = best_of(
+        repeat,
+        timings,
+        "scan_work_packages",
+        lambda: [
+            work_package
+            for work_package in scan_work_packages(xml_files, jobs=jobs)
+            if work_package.opening_tag is not None
+        ],
+    )
+
+    # A network share stand-in: every read waits first, once one at a time and once read ahead
+    if latency > 0:
+        reader = functools.partial(read_delayed, latency)
+        for phase, reads in (("scan_delayed", 1), ("scan_read_ahead", read_ahead)):
+            best_of(
+                repeat,
+                timings,
+                phase,
+                lambda reads=reads: list(
+                    scan_work_packages(xml_files, read_ahead=reads, reader=reader)
+                ),
+            )
+
+    # Rescanning with a warm cache only has to stat every file
+    with tempfile.TemporaryDirectory() as cache_dir:
+        with ScanCache(Path(cache_dir) / "cache.sqlite") as cache:
+            list(scan_work_packages(xml_files, cache, jobs=jobs))
+            best_of(
+                repeat,
+                timings,
+                "rescan_cached",
+                lambda: list(scan_work_packages(xml_files, cache, jobs=jobs)),
+            )
+
+    # The first update rewrites every prolog; the second finds nothing left to change
+    updated = best_of(
+        1,
+        timings,
+        "update_files",
+        lambda: [
+            work_package
+            for _, work_package in update_work_packages(work_packages, entity_index, jobs=jobs)
+        ],
+    )
+    best_of(
+        repeat,
+        timings,
+        "update_unchanged",
+        lambda: list(update_work_packages(updated, entity_index, jobs=jobs)),
+    )
+
+    return {"work_packages": len(xml_files), "seconds": timings}
+
+
+def read_delayed(latency: float, path: Path) -> tuple:
+    """"""
+    time.sleep(latency)
+    return read_work_package(path)
+
+
+def best_of(repeat: int, timings: dict, phase: str, function: Callable, *args):
+    """"""
+    result = None
+    best = None
+    for _ in range(max(repeat, 1)):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    timings[phase] = round(best, 4)
+    return result
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    """"""
+    parser = argparse.ArgumentParser(
+        description="Time the scanner phases on generated IADS projects of several sizes."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SIZES,
+        help="number of work packages per generated project (default: 100 1000 10000)",
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=SCAN_JOBS, help="worker count")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per phase, best is kept")
+    parser.add_argument(
+        "--entities", type=int, default=ENTITIES_PER_FILE, help="declarations per entity file"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="also time scans whose every read is delayed this long, one at a time and read ahead",
+    )
+    parser.add_argument(
+        "--read-ahead",
+        type=int,
+        default=DEFAULT_READ_AHEAD,
+        metavar="N",
+        help=f"reads in flight for the delayed read-ahead scan (default: {DEFAULT_READ_AHEAD})",
+    )
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = parser.parse_args(argv)
+    if args.latency > 0 and args.read_ahead < 1:
+        parser.error("--read-ahead must be at least 1 to time the delayed read-ahead scan")
+
+    results = []
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory(prefix="iads-benchmark-") as folder:
+            folder_path = generate_project(Path(folder), size, args.entities)
+            result = run_benchmark(
+                folder_path, args.jobs, args.repeat, args.latency, args.read_ahead
+            )
+        results.append(result)
+
+        phases = ", ".join(
+            f"{phase} {seconds:.3f}s" for phase, seconds in result["seconds"].items()
+        )
+        print(f"{size:>6} WPs: {phases}", flush=True)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2) + "\n", encoding="utf-8")
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,664 @@
+"""IADS ENTITY SCANNER CLI"""
+
+import argparse
+import contextlib
+import os
+import sqlite3
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Iterator, Optional
+
+from batch import merge_results, parse_shard, run_batch
+from profiling import Profiler, get_profiler_from_env, profile_phase
+from server import SERVER_HOST, SERVER_PORT, ScanServer
+from scanner import (
+    SCAN_CHUNK_SIZE,
+    SCAN_JOBS,
+    SKIPPED,
+    UNCHANGED,
+    WATCH_INTERVAL,
+    WRITTEN,
+    ManifestWriter,
+    ProjectInventory,
+    ProjectWatcher,
+    ScanCache,
+    UsageIndex,
+    WorkPackage,
+    build_entity_index,
+    get_doctype_lines,
+    get_manifest_format,
+    get_manifest_record,
+    get_missing_graphics,
+    get_unreferenced_graphics,
+    open_scan_cache,
+    render_prolog,
+    scan_entity_files,
+    scan_work_packages,
+    update_work_packages,
+    walk_project,
+)
+
+# Exit codes (argparse already exits with 2 on usage errors)
+EXIT_OK = 0
+EXIT_FAILURE = 1
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    """"""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    # Read-ahead analyzes in the main process, so it has no use for worker processes
+    if getattr(args, "read_ahead", 0) > 0 and getattr(args, "processes", False):
+        parser.error("--read-ahead can't be combined with --processes")
+
+    # Batch commands take their own list of projects
+    folder_path = Path(args.project) if args.project is not None else None
+    if folder_path is not None and not folder_path.is_dir():
+        print(f"error: {folder_path} is not a folder", file=sys.stderr)
+        return EXIT_FAILURE
+
+    args.profiler = get_profiler(args)
+    try:
+        with args.profiler.profile() if args.profiler else contextlib.nullcontext():
+            return args.command(args, folder_path)
+    except (OSError, UnicodeDecodeError, sqlite3.Error) as error:
+        print(f"error: {error}", file=sys.stderr)
+        return EXIT_FAILURE
+    finally:
+        # The timing summary goes to stderr so it never mixes with the scan output
+        if args.profiler:
+            print(args.profiler.finish(), file=sys.stderr)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """"""
+    parser = argparse.ArgumentParser(
+        prog="iads-entity-scanner",
+        description="Preview and update the DOCTYPE entity declarations of IADS work packages.",
+    )
+    subparsers = parser.add_subparsers(required=True, metavar="command")
+
+    # Options shared by every subcommand
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("project", help="root folder of the IADS project")
+    common.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=SCAN_JOBS,
+        help=f"number of workers used to analyze and rewrite files (default: {SCAN_JOBS})",
+    )
+    common.add_argument(
+        "--chunk-size",
+        type=get_positive,
+        default=SCAN_CHUNK_SIZE,
+        metavar="N",
+        help=f"files handed to a worker at a time (default: {SCAN_CHUNK_SIZE})",
+    )
+    common.add_argument(
+        "--processes",
+        action="store_true",
+        help="use worker processes instead of threads",
+    )
+    common.add_argument(
+        "--read-ahead",
+        type=int,
+        default=0,
+        metavar="N",
+        help="keep N file reads in flight ahead of the analysis, for projects on slow network "
+        "shares (default: 0, off)",
+    )
+    common.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="ignore the incremental scan cache and read every file",
+    )
+    common.add_argument(
+        "--profile",
+        nargs="?",
+        const="",
+        metavar="REPORT",
+        help="print per-phase timings and the slowest files, and write them to REPORT as JSON",
+    )
+    common.add_argument(
+        "--cprofile",
+        metavar="FILE",
+        help="write a cProfile dump of the main thread to FILE (use with --jobs 1 for all calls)",
+    )
+
+    scan_parser = subparsers.add_parser(
+        "scan", parents=[common], help="print the DOCTYPE each work package should have"
+    )
+    scan_parser.set_defaults(command=run_scan)
+
+    update_parser = subparsers.add_parser(
+        "update", parents=[common], help="write the new DOCTYPE into each work package"
+    )
+    update_parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="print the prologs that would change without touching any file",
+    )
+    update_parser.set_defaults(command=run_update)
+
+    graphics_parser = subparsers.add_parser(
+        "graphics",
+        parents=[common],
+        help="list graphics missing from graphics-SVG and SVGs no work package uses",
+    )
+    graphics_parser.set_defaults(command=run_graphics)
+
+    manifest_parser = subparsers.add_parser(
+        "manifest",
+        parents=[common],
+        help="write one JSON Lines or CSV record per work package as it is scanned",
+    )
+    manifest_parser.add_argument(
+        "-o",
+        "--output",
+        default="-",
+        metavar="FILE",
+        help="manifest file, CSV if it ends in .csv (default: JSON Lines on stdout)",
+    )
+    manifest_parser.add_argument(
+        "--format", choices=("jsonl", "csv"), help="override the format chosen from --output"
+    )
+    manifest_parser.set_defaults(command=run_manifest)
+
+    serve_parser = subparsers.add_parser(
+        "serve",
+        parents=[common],
+        help="keep the project loaded and answer scan, prolog and update requests over HTTP",
+    )
+    serve_parser.add_argument(
+        "--host", default=SERVER_HOST, help=f"address to listen on (default: {SERVER_HOST})"
+    )
+    serve_parser.add_argument(
+        "--port", type=int, default=SERVER_PORT, help=f"port to listen on (default: {SERVER_PORT})"
+    )
+    serve_parser.set_defaults(command=run_serve)
+
+    batch_parser = subparsers.add_parser(
+        "batch",
+        help="scan or update several projects at once, or one shard of a large project",
+    )
+    batch_parser.add_argument("projects", nargs="+", metavar="project", help="project folder")
+    batch_parser.add_argument(
+        "-o",
+        "--output-dir",
+        default=".",
+        metavar="DIR",
+        help="folder for the result file of each project (default: current folder)",
+    )
+    batch_parser.add_argument(
+        "--shard",
+        type=get_shard,
+        metavar="k/N",
+        help="only handle the k-th of N deterministic shards of every project's work packages",
+    )
+    batch_parser.add_argument(
+        "-u", "--update", action="store_true", help="also write the new DOCTYPEs"
+    )
+    batch_parser.add_argument(
+        "-n", "--dry-run", action="store_true", help="with --update, only report what would change"
+    )
+    batch_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=SCAN_JOBS,
+        help=f"number of workers per project (default: {SCAN_JOBS})",
+    )
+    batch_parser.add_argument(
+        "-p",
+        "--parallel",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of projects handled at once, each in its own process (default: CPU count)",
+    )
+    batch_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="ignore the incremental scan cache and read every file",
+    )
+    batch_parser.set_defaults(command=run_batch_command, project=None, profile=None, cprofile=None)
+
+    merge_parser = subparsers.add_parser(
+        "merge", help="merge the result files of a sharded batch into one JSON Lines file"
+    )
+    merge_parser.add_argument("results", nargs="+", metavar="RESULT", help="batch result file")
+    merge_parser.add_argument(
+        "-o", "--output", default="-", metavar="FILE", help="merged file (default: stdout)"
+    )
+    merge_parser.set_defaults(command=run_merge, project=None, profile=None, cprofile=None)
+
+    watch_parser = subparsers.add_parser(
+        "watch",
+        parents=[common],
+        help="poll the project and print the DOCTYPE of every work package that changes",
+    )
+    watch_parser.add_argument(
+        "-i",
+        "--interval",
+        type=get_interval,
+        default=WATCH_INTERVAL,
+        help=f"seconds between polls (default: {WATCH_INTERVAL:g})",
+    )
+    watch_parser.add_argument(
+        "-u",
+        "--update",
+        action="store_true",
+        help="also write the new DOCTYPE into the changed work packages",
+    )
+    watch_parser.set_defaults(command=run_watch)
+
+    # Options of the commands that query the usage index
+    usage = argparse.ArgumentParser(add_help=False)
+    usage.add_argument(
+        "--index", metavar="FILE", help="query a usage index saved earlier instead of scanning"
+    )
+    usage.add_argument("--save", metavar="FILE", help="save the usage index to FILE")
+
+    who_uses_parser = subparsers.add_parser(
+        "who-uses",
+        parents=[common, usage],
+        help="list the work packages that use an entity or graphic",
+    )
+    who_uses_parser.add_argument(
+        "names", nargs="+", metavar="NAME", help="entity name or board number (wildcards allowed)"
+    )
+    who_uses_parser.set_defaults(command=run_who_uses)
+
+    uses_parser = subparsers.add_parser(
+        "uses",
+        parents=[common, usage],
+        help="list the entities and graphics a work package uses",
+    )
+    uses_parser.add_argument("paths", nargs="+", metavar="WP", help="work package file")
+    uses_parser.set_defaults(command=run_uses)
+
+    return parser
+
+
+def run_scan(args: argparse.Namespace, folder_path: Path) -> int:
+    """"""
+    with get_cache(args, folder_path) as cache:
+        inventory = walk(args, folder_path)
+        entity_index = load_entity_index(args, inventory, cache)
+        xml_files = inventory.work_packages
+        if not xml_files:
+            print(f"error: no XML files found to scan in {folder_path}", file=sys.stderr)
+            return EXIT_FAILURE
+
+        with profile_phase(args.profiler, "scan"):
+            for work_package in scan(args, xml_files, cache):
+                if work_package.opening_tag is not None:
+                    print(work_package.path.relative_to(folder_path))
+                    print("\n".join(get_doctype_lines(work_package, entity_index)), end="\n\n")
+
+    return EXIT_OK
+
+
+def run_update(args: argparse.Namespace, folder_path: Path) -> int:
+    """"""
+    with get_cache(args, folder_path) as cache:
+        inventory = walk(args, folder_path)
+        entity_index = load_entity_index(args, inventory, cache)
+        xml_files = inventory.work_packages
+        if not xml_files:
+            print(f"error: no XML files found to update in {folder_path}", file=sys.stderr)
+            return EXIT_FAILURE
+
+        with profile_phase(args.profiler, "scan"):
+            work_packages = [
+                work_package
+                for work_package in scan(args, xml_files, cache)
+                if work_package.opening_tag is not None
+            ]
+
+        updated = update_work_packages(
+            work_packages,
+            entity_index,
+            cache,
+            args.jobs,
+            args.processes,
+            args.dry_run,
+            profiler=args.profiler,
+            chunk_size=args.chunk_size,
+        )
+        status_counts = Counter()
+        with profile_phase(args.profiler, "update"):
+            for status, work_package in updated:
+                status_counts[status] += 1
+                # On a dry run, show the prolog each changed file would get
+                if args.dry_run and status == WRITTEN:
+                    print(work_package.path.relative_to(folder_path))
+                    print(render_prolog(work_package, entity_index))
+
+    action = "Would write" if args.dry_run else "Written"
+    print(
+        f"{action}: {status_counts[WRITTEN]}, "
+        f"unchanged: {status_counts[UNCHANGED]}, "
+        f"skipped: {status_counts[SKIPPED]}"
+    )
+    return EXIT_OK
+
+
+def run_graphics(args: argparse.Namespace, folder_path: Path) -> int:
+    """"""
+    with get_cache(args, folder_path) as cache:
+        inventory = walk(args, folder_path)
+        if not inventory.work_packages:
+            print(f"error: no XML files found to check in {folder_path}", file=sys.stderr)
+            return EXIT_FAILURE
+
+        work_packages = []
+        missing_count = 0
+        with profile_phase(args.profiler, "scan"):
+            for work_package in scan(args, inventory.work_packages, cache):
+                if work_package.opening_tag is None:
+                    continue
+                work_packages.append(work_package)
+                missing = get_missing_graphics(work_package, inventory.graphics)
+                if missing:
+                    missing_count += len(missing)
+                    print(work_package.path.relative_to(folder_path))
+                    print("\n".join(f"\tmissing {boardno}" for boardno in missing))
+
+    unreferenced = get_unreferenced_graphics(work_packages, inventory.graphics)
+    for boardno in unreferenced:
+        print(f"unreferenced {inventory.graphics[boardno].relative_to(folder_path)}")
+    print(f"Missing graphics: {missing_count}, unreferenced graphics: {len(unreferenced)}")
+
+    # Missing graphics break the publication, so let scripts stop on them
+    return EXIT_FAILURE if missing_count else EXIT_OK
+
+
+def run_manifest(args: argparse.Namespace, folder_path: Path) -> int:
+    """"""
+    output_path = Path(args.output)
+    manifest_format = args.format or get_manifest_format(output_path)
+    with contextlib.ExitStack() as stack:
+        cache = stack.enter_context(get_cache(args, folder_path))
+        inventory = walk(args, folder_path)
+        entity_index = load_entity_index(args, inventory, cache)
+        if not inventory.work_packages:
+            print(f"error: no XML files found to scan in {folder_path}", file=sys.stderr)
+            return EXIT_FAILURE
+
+        stream = sys.stdout
+        if args.output != "-":
+            stream = stack.enter_context(output_path.open("w", encoding="utf-8", newline=""))
+        manifest = ManifestWriter(stream, manifest_format)
+        with profile_phase(args.profiler, "scan"):
+            for work_package in scan(args, inventory.work_packages, cache):
+                if work_package.opening_tag is not None:
+                    manifest.write(get_manifest_record(work_package, entity_index, folder_path))
+
+    return EXIT_OK
+
+
+def run_serve(args: argparse.Namespace, folder_path: Path) -> int:
+    """"""
+    with get_cache(args, folder_path) as cache:
+        with ScanServer(
+            folder_path, (args.host, args.port), cache, args.jobs, args.read_ahead
+        ) as server:
+            host, port = server.server_address[:2]
+            print(f"Serving {folder_path} on http://{host}:{port}", flush=True)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+    return EXIT_OK
+
+
+def run_batch_command(args: argparse.Namespace, _: Optional[Path]) -> int:
+    """"""
+    folder_paths = [Path(project) for project in args.projects]
+    for folder_path in folder_paths:
+        if not folder_path.is_dir():
+            print(f"error: {folder_path} is not a folder", file=sys.stderr)
+            return EXIT_FAILURE
+    # Result files are named after the project folder, so those have to be unique
+    names = Counter(folder_path.name for folder_path in folder_paths)
+    if max(names.values()) > 1:
+        duplicates = ", ".join(sorted(name for name, count in names.items() if count > 1))
+        print(f"error: more than one project is named {duplicates}", file=sys.stderr)
+        return EXIT_FAILURE
+
+    exit_code = EXIT_OK
+    for folder_path, result, error in run_batch(
+        folder_paths,
+        Path(args.output_dir),
+        args.shard,
+        args.update,
+        args.dry_run,
+        args.jobs,
+        args.parallel,
+        not args.no_cache,
+    ):
+        if error:
+            print(f"error: {folder_path}: {error}", file=sys.stderr)
+            exit_code = EXIT_FAILURE
+            continue
+        counts = ", ".join(f"{status}: {count}" for status, count in result["counts"].items())
+        shard = "/".join(map(str, result["shard"]))
+        print(f"{folder_path} {shard}: {counts or 'no work packages'}")
+
+    return exit_code
+
+
+def run_merge(args: argparse.Namespace, _: Optional[Path]) -> int:
+    """"""
+    result_paths = [Path(result) for result in args.results]
+    with contextlib.ExitStack() as stack:
+        stream = sys.stdout
+        if args.output != "-":
+            stream = stack.enter_context(Path(args.output).open("w", encoding="utf-8"))
+        try:
+            totals = merge_results(result_paths, stream)
+        except ValueError as error:
+            print(f"error: {error}", file=sys.stderr)
+            return EXIT_FAILURE
+
+    for project, status_counts in totals.items():
+        counts = ", ".join(f"{status}: {count}" for status, count in status_counts.items())
+        print(f"{project}: {counts or 'no work packages'}", file=sys.stderr)
+    return EXIT_OK
+
+
+def run_watch(args: argparse.Namespace, folder_path: Path) -> int:
+    """"""
+    with get_cache(args, folder_path) as cache:
+        watcher = ProjectWatcher(folder_path, cache, args.jobs, args.read_ahead)
+        first_poll = True
+        try:
+            while True:
+                try:
+                    watch_poll(args, folder_path, watcher, cache, first_poll)
+                    first_poll = False
+                except OSError as error:
+                    # A file removed mid-poll or a share dropping out is polled again next time
+                    print(f"warning: {error}", file=sys.stderr)
+                sys.stdout.flush()
+                time.sleep(args.interval)
+        except KeyboardInterrupt:
+            return EXIT_OK
+
+
+def watch_poll(
+    args: argparse.Namespace,
+    folder_path: Path,
+    watcher: ProjectWatcher,
+    cache: Optional[ScanCache],
+    first_poll: bool,
+) -> None:
+    """"""
+    changes = watcher.poll()
+    if first_poll:
+        print(f"Watching {len(watcher.work_packages)} XML files in {folder_path}")
+    else:
+        for path in changes.entity_files:
+            print(f"reloaded {path.relative_to(folder_path)}")
+        for path in changes.removed:
+            print(f"removed {path.relative_to(folder_path)}")
+        for work_package in changes.work_packages:
+            print(work_package.path.relative_to(folder_path))
+            lines = get_doctype_lines(work_package, watcher.entity_index)
+            print("\n".join(lines), end="\n\n")
+
+    # The first poll brings the whole project up to date, later ones what changed
+    if args.update and changes.work_packages:
+        status_counts = Counter()
+        for status, work_package in update_work_packages(
+            changes.work_packages,
+            watcher.entity_index,
+            cache,
+            args.jobs,
+            args.processes,
+            chunk_size=args.chunk_size,
+        ):
+            status_counts[status] += 1
+            if work_package:
+                watcher.remember(work_package)
+        print(
+            f"Written: {status_counts[WRITTEN]}, "
+            f"unchanged: {status_counts[UNCHANGED]}, "
+            f"skipped: {status_counts[SKIPPED]}",
+            flush=True,
+        )
+
+
+def run_who_uses(args: argparse.Namespace, folder_path: Path) -> int:
+    """"""
+    usage_index = get_usage_index(args, folder_path)
+    found = False
+    for pattern in args.names:
+        for name, paths in usage_index.find(pattern).items():
+            found = True
+            print(name)
+            print("\n".join(f"\t{get_display_path(path, folder_path)}" for path in paths))
+    return EXIT_OK if found else EXIT_FAILURE
+
+
+def run_uses(args: argparse.Namespace, folder_path: Path) -> int:
+    """"""
+    usage_index = get_usage_index(args, folder_path)
+    # Accept paths relative to the current folder or to the project
+    scanned = {path.resolve(): path for path in usage_index.work_packages}
+    found = False
+    for argument in args.paths:
+        path = scanned.get(Path(argument).resolve()) or scanned.get(
+            (folder_path / argument).resolve()
+        )
+        if path is None:
+            print(f"error: {argument} is not a scanned work package", file=sys.stderr)
+            continue
+        found = True
+        entities, graphics = usage_index.uses(path)
+        print(get_display_path(path, folder_path))
+        print("".join(f"\tentity {name}\n" for name in entities), end="")
+        print("".join(f"\tgraphic {boardno}\n" for boardno in graphics), end="")
+    return EXIT_OK if found else EXIT_FAILURE
+
+
+def get_display_path(path: Path, folder_path: Path) -> Path:
+    """"""
+    # An index saved from another project root may hold paths outside this one
+    return path.relative_to(folder_path) if path.is_relative_to(folder_path) else path
+
+
+def get_usage_index(args: argparse.Namespace, folder_path: Path) -> UsageIndex:
+    """"""
+    if args.index:
+        usage_index = UsageIndex.load(Path(args.index), folder_path)
+    else:
+        usage_index = UsageIndex()
+        with get_cache(args, folder_path) as cache:
+            inventory = walk(args, folder_path)
+            with profile_phase(args.profiler, "scan"):
+                for work_package in scan(args, inventory.work_packages, cache):
+                    if work_package.opening_tag is not None:
+                        usage_index.add(work_package)
+
+    if args.save:
+        usage_index.save(Path(args.save), folder_path)
+    return usage_index
+
+
+def walk(args: argparse.Namespace, folder_path: Path) -> ProjectInventory:
+    """"""
+    with profile_phase(args.profiler, "walk"):
+        return walk_project(folder_path)
+
+
+def load_entity_index(args: argparse.Namespace, inventory: ProjectInventory, cache) -> dict:
+    """"""
+    with profile_phase(args.profiler, "entity_files"):
+        ext_entity_dict = scan_entity_files(inventory.entity_files, cache, args.profiler)
+    with profile_phase(args.profiler, "entity_index"):
+        return build_entity_index(ext_entity_dict)
+
+
+def scan(args: argparse.Namespace, xml_files: list[Path], cache) -> Iterator[WorkPackage]:
+    """"""
+    return scan_work_packages(
+        xml_files,
+        cache,
+        args.jobs,
+        args.processes,
+        profiler=args.profiler,
+        read_ahead=args.read_ahead,
+        chunk_size=args.chunk_size,
+    )
+
+
+def get_shard(text: str) -> tuple[int, int]:
+    """"""
+    try:
+        return parse_shard(text)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error)) from error
+
+
+def get_positive(text: str) -> int:
+    """"""
+    try:
+        number = int(text)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"invalid count {text!r}, expected a positive number")
+    return number
+
+
+def get_interval(text: str) -> float:
+    """"""
+    try:
+        seconds = float(text)
+    except ValueError:
+        seconds = 0.0
+    if not seconds > 0:
+        raise argparse.ArgumentTypeError(f"invalid interval {text!r}, expected positive seconds")
+    return seconds
+
+
+def get_profiler(args: argparse.Namespace) -> Optional[Profiler]:
+    """"""
+    # The command line options win over the IADS_PROFILE and IADS_CPROFILE variables
+    if args.profile is None and args.cprofile is None:
+        return get_profiler_from_env()
+    return Profiler(args.profile or None, args.cprofile)
+
+
+def get_cache(args: argparse.Namespace, folder_path: Path):
+    """"""
+    return contextlib.nullcontext() if args.no_cache else open_scan_cache(folder_path)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,600 +1,597 @@
 """IADS ENTITY SCANNER"""
 
 import contextlib
+import functools
 import itertools
 
 # import logging
-import re
+import queue
 import sys
 import threading
+import time
+from collections import Counter
 
 # import timeit
 import tkinter.font as tkfont
 from pathlib import Path
 from tkinter import TclError, filedialog, messagebox
 from tkinter import scrolledtext as st
-from typing import Optional
+from typing import Callable, Iterator, Optional
 
 import ttkbootstrap as ttk
 from PIL import Image, ImageTk
-from ttkbootstrap.constants import BOTH, BOTTOM, DISABLED, END, LEFT, TOP, WORD, E, W, X
-
-CHAPTER_TAGS = (
-    "gim",
-    "opim",
-    "tim",
-    "mim",
-    "dim",
-    "pim",
-    "sim",
-    "paper.manual",
-    "production",
+from ttkbootstrap.constants import BOTH, BOTTOM, DISABLED, END, LEFT, NORMAL, TOP, WORD, E, W, X
+
+from profiling import Profiler, get_profiler_from_env, profile_phase
+from scanner import (
+    DOCTYPE_END,
+    DOCTYPE_TAG_END,
+    SKIPPED,
+    UNCHANGED,
+    WATCH_INTERVAL,
+    WRITTEN,
+    ManifestWriter,
+    ProjectWatcher,
+    UsageIndex,
+    WorkPackage,
+    build_entity_index,
+    get_cache_path,
+    get_entity_lines,
+    get_manifest_format,
+    get_manifest_record,
+    get_missing_graphics,
+    get_unreferenced_graphics,
+    get_usage_index_path,
+    open_scan_cache,
+    scan_entity_files,
+    scan_work_packages,
+    update_work_packages,
+    walk_project,
 )
+
 CUSTOM_TBUTTON = "Custom.TButton"
+entity_index = {}
 ext_entity_dict = {}
-files_to_skip = (
-    "chap",
-    "start",
-    "submission",
-    "production",
-    "catalog",
-    "entity",
-    "dataset",
-    "toc",
-    "999",
-)
 FOLDER_PATH = Path()
-GRAPHIC_TAGS = ("<graphic ", "<icon-set ", "<symbol ", "<authent ", "<back ")
-
-
-def scan_folder_in_background() -> None:
-    """"""
-    thread = threading.Thread(target=open_iads_dir)
-    thread.start()
+graphics_index = {}
+JOB_FINISHED = object()
+# Work packages shown per preview page
+PREVIEW_PAGE_SIZE = 500
+# Milliseconds between progress bar redraws and between polls of the worker queue
+PROGRESS_INTERVAL_MS = 100
+QUEUE_POLL_MS = 50
+WATCH_DRAIN_MS = 500
+# Whether the last scan finished, so its results can be written back or exported
+scan_complete = False
+scan_results = {}
+usage_index = UsageIndex()
+# Changes found by the watcher thread, and the event that stops the current watch
+watch_queue = queue.Queue()
+watch_stop: Optional[threading.Event] = None
+# Results a worker can queue ahead of the GUI before it has to wait
+WORK_QUEUE_SIZE = 256
 
 
 def open_iads_dir() -> None:
     """"""
-    textbox.delete("1.0", END)
-    global FOLDER_PATH
-    FOLDER_PATH = Path(filedialog.askdirectory())
+    # Ask for the folder on the main thread; only the scan itself runs in the background
+    folder = filedialog.askdirectory()
+    if not folder:
+        return
 
+    global FOLDER_PATH
+    FOLDER_PATH = Path(folder)
     if FOLDER_PATH.exists():
         scan_iads_folder(FOLDER_PATH)
-        # # Measure the time taken for 10 executions of scan_iads_folder
-        # execution_time: float = timeit.timeit(
-        #     "scan_iads_folder(FOLDER_PATH)", globals=globals(), number=10
-        # )
-        # logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
-        # logging.info("Execution time: %s seconds", execution_time)
-    update_btn.configure(state="normal")
 
 
 def scan_iads_folder(folder_path: Path) -> None:
     """"""
-    global ext_entity_dict  # pylint: disable=W0603
-    ext_entity_dict = scan_entity_files(folder_path)
-    scan_work_package_files(folder_path, ext_entity_dict)
+    global scan_complete, usage_index  # pylint: disable=W0603
+    # Never clear the results of a job that is still running
+    if BackgroundJob.current is not None:
+        return
+    stop_watching()
+    preview.clear()
+    scan_results.clear()
+    scan_complete = False
+    usage_index = UsageIndex()
+    BackgroundJob(
+        functools.partial(scan_project, folder_path),
+        handle_scan_item,
+        finish_scan,
+        get_job_profiler(folder_path),
+    ).start()
+
+
+def scan_project(folder_path: Path, job: "BackgroundJob") -> Iterator:
+    """"""
+    profiler = job.profiler
+    with open_scan_cache(folder_path) as cache:
+        # One walk finds the entity files and the XML files that need to be processed
+        with profile_phase(profiler, "walk"):
+            inventory = walk_project(folder_path)
+        with profile_phase(profiler, "entity_files"):
+            ext_entity_dict = scan_entity_files(inventory.entity_files, cache, profiler)
+        with profile_phase(profiler, "entity_index"):
+            entity_index = build_entity_index(ext_entity_dict)
+        job.result = (ext_entity_dict, entity_index, inventory.graphics)
+
+        xml_files = inventory.work_packages
+        job.total = len(xml_files)
+
+        with profile_phase(profiler, "scan"):
+            for work_package in scan_work_packages(
+                xml_files, cache, cancel=job.cancel, profiler=profiler
+            ):
+                # Render the preview here so the main loop only has to insert it
+                segments = None
+                if work_package.opening_tag is not None:
+                    segments = get_preview_segments(work_package, entity_index, inventory.graphics)
+                yield work_package, segments
 
 
-def scan_entity_files(folder_path: Path) -> dict:
+def handle_scan_item(job: "BackgroundJob", item: tuple) -> None:
     """"""
-    ext_entity_dict = {}
-    folder_path = Path(folder_path)
+    work_package, segments = item
+    if segments:
+        # Keep the analysis so the update writes exactly what was previewed
+        scan_results[work_package.path] = work_package
+        usage_index.add(work_package)
+        preview.add(work_package.path, segments)
 
-    # Iterate over all .ent files in the directory and subdirectories
-    for path in folder_path.rglob("*.ent"):
-        path_str = str(path).lower()
-        # Check if the path contains "boilerplate" or "entities"
-        if "boilerplate" in path_str or "entities" in path_str:
-            # Open and read the entity file
-            with path.open("r", encoding="utf-8") as entity_file:
-                entity_list = entity_file.read().splitlines()
-                entity_list = get_external_entities_from_ent_file(entity_list)
-                ext_entity_dict[path.stem] = entity_list
 
-    return ext_entity_dict
+def finish_scan(job: "BackgroundJob") -> None:
+    """"""
+    global ext_entity_dict, entity_index, graphics_index, scan_complete  # pylint: disable=W0603
+    if job.error:
+        messagebox.showerror("ERROR", f"The scan failed:\n\n{job.error}")
+    elif job.cancel.is_set():
+        messagebox.showinfo("CANCELLED", "The scan was cancelled.")
+    elif job.total == 0:
+        messagebox.showinfo("Info", "No XML files found to scan.")
+    else:
+        ext_entity_dict, entity_index, graphics_index = job.result
+        # Only a complete scan can be written back to the work packages or exported
+        scan_complete = True
+        with contextlib.suppress(OSError):
+            usage_index.save(get_usage_index_path(FOLDER_PATH), FOLDER_PATH)
+        if watch_var.get():
+            start_watching(FOLDER_PATH)
+
+        work_packages = list(scan_results.values())
+        missing = [get_missing_graphics(wp, graphics_index) for wp in work_packages]
+        unreferenced = get_unreferenced_graphics(work_packages, graphics_index)
+        messagebox.showinfo(
+            "SUCCESS",
+            "Files scanned successfully\n\n"
+            f"Missing graphics: {sum(map(len, missing))} "
+            f"in {sum(map(bool, missing))} work packages\n"
+            f"Unreferenced graphics: {len(unreferenced)}",
+        )
 
 
-def scan_work_package_files(folder_path: Path, ext_entity_dict: dict) -> None:
+def get_preview_segments(work_package: WorkPackage, entity_index: dict, graphics: dict) -> list:
     """"""
-    # Create a progress bar widget
-    progress_bar = ttk.Progressbar(root, orient="horizontal", length=300, mode="determinate")
-    progress_bar.pack(pady=10)
-
-    # Get a list of all XML files that need to be processed
-    xml_files = [
-        path
-        for path in folder_path.rglob("files/*.xml")
-        if not any(term in path.name.lower() for term in files_to_skip)
+    # Text and tag pairs, ready to be passed to a single textbox.insert call
+    entity_lines = "".join(f"{entity}\n" for entity in get_entity_lines(work_package, entity_index))
+    missing = get_missing_graphics(work_package, graphics)
+    missing_line = f"Missing graphics: {', '.join(missing)}\n" if missing else ""
+    return [
+        # Print path of the work package file
+        f"{work_package.path.name}\n",
+        "path",
+        # Print Opening Caret in aqua, DOCTYPE in lavender and the opening tag in red
+        "<!",
+        "aqua",
+        "DOCTYPE ",
+        "lavender",
+        work_package.opening_tag,
+        "red",
+        # Print Public ID and DTD path in aqua
+        f" {DOCTYPE_TAG_END}\n",
+        "aqua",
+        entity_lines,
+        (),
+        f"{DOCTYPE_END}\n",
+        "aqua",
+        # Flag graphics the DOCTYPE points at that aren't in graphics-SVG
+        f"{missing_line}\n",
+        "red",
     ]
-    max_value = len(xml_files)
 
-    if max_value == 0:
-        # If no files are found, display an informational message and remove the progress bar
-        messagebox.showinfo("Info", "No XML files found to scan.")
-        progress_bar.destroy()
-        return
 
-    # Set the maximum value for the progress bar
-    progress_bar["maximum"] = max_value
-    progress_bar["value"] = 0  # Reset the progress bar value
-
-    # Iterate through all XML files and process them
-    for i, path in enumerate(xml_files, start=1):
-        # Open and read the work package file using a context manager
-        path_str = str(path).lower()
-        if (
-            not any(term in path.name.lower() for term in files_to_skip)
-            and "!submission" not in path_str
-        ):
-            with path.open("r", encoding="utf-8") as work_package:
-                new_external_entities = []
-                new_graphics = []
-
-                if get_opening_tag(path) is None:
-                    # If the file is empty, skip processing, display empty file message
-                    # textbox.tag_configure("red", foreground="red", font="Monaco")
-                    # textbox.insert(END, f"Work package {path.name} is empty.\n\n", "red")
-                    continue
-
-                else:
-                    # Print path of the work package file in the textbox
-                    textbox.tag_configure("path", font=("Arial", 12, "bold"))
-                    textbox.insert(END, f"{path.name}\n", "path")
-
-                    print_doctype_declaration(path)
-
-                    # Break the file into lines and scan for entities
-                    lines = work_package.read().splitlines()
-                    scan_lines_for_entities(
-                        lines, ext_entity_dict, new_external_entities, new_graphics
-                    )
-
-                    # Combine and sort all unique entities (graphics and external entities)
-                    total_entities = list(itertools.chain(new_graphics, new_external_entities))
-                    sorted_entities = sorted(set(total_entities))
-
-                    # Insert each entity into the textbox
-                    for entity in sorted_entities:
-
-                        # Add the selectboil entity declaration if editboil entity is found
-                        if "edit" in entity:
-                            selectboil: str = (
-                                '\t<!ENTITY % select_boilerplate PUBLIC "-//USA-DOD//ENTITIES MIL-STD-40051 Selection Boilerplate REV D 7.0 20220130//EN" '
-                                '"../dtd/boilerplate/selectboil.ent"> %select_boilerplate;'
-                            )
-                            textbox.insert(END, f"{selectboil}\n")
-                            textbox.insert(END, f"{entity}\n")
-                        else:
-                            textbox.insert(END, f"{entity}\n")
-                        # Color-code the entity declarations
-                        # if "<!ENTITY %" in entity:
-                        #     open_tag = entity.split("ENTITY")[0]
-                        #     entity_name = entity.split(
-                        #         "ENTITY % ")[1].strip(" ")
-                        #     textbox.tag_configure(
-                        #         "aqua", foreground="aqua", font="Monaco")
-                        #     textbox.insert(END, f"{open_tag}", "aqua")
-                        #     textbox.tag_configure(
-                        #         "lavender", foreground="lavender", font="Monaco")
-                        #     textbox.insert(END, "ENTITY", "lavender")
-                        #     textbox.tag_configure(
-                        #         "aqua", foreground="aqua", font="Monaco")
-                        #     textbox.insert(END, " % ", "aqua")
-                        #     textbox.tag_configure(
-                        #         "red", foreground="red", font="Monaco")
-                        #     textbox.insert(END, f"{entity_name}", "red")
-                        #     textbox.insert(END, f"{entity}\n", "aqua")
-                        # elif "%" not in entity:
-                        #     textbox.insert(END, f"{entity}\n")
-                    textbox.tag_configure("aqua", foreground="aqua", font="Monaco")
-                    textbox.insert(END, "]>\n\n", "aqua")
-
-        # Update the progress bar
-        progress_bar["value"] = i
-        root.update_idletasks()  # Ensure the GUI is updated during the loop
-
-    # Once processing is complete, destroy the progress bar
-    progress_bar.destroy()
-
-    # Show a success message
-    messagebox.showinfo("SUCCESS", "Files scanned successfully")
-
-
-def scan_lines_for_entities(
-    lines: list[str],
-    ext_entity_dict: dict,
-    new_external_entities: list,
-    new_graphics: list,
-) -> None:
+def update_files_in_background() -> None:
     """"""
-    for line in lines:
-        process_graphic_tags(line, new_graphics)
-        process_external_entities(line, ext_entity_dict, new_external_entities)
+    if BackgroundJob.current is not None:
+        return
+    job = BackgroundJob(
+        functools.partial(update_project, FOLDER_PATH, list(scan_results.values()), entity_index),
+        handle_update_item,
+        finish_update,
+        get_job_profiler(FOLDER_PATH),
+    )
+    job.result = Counter()
+    job.start()
 
 
-def process_graphic_tags(line: str, new_graphics: list) -> None:
+def update_project(
+    folder_path: Path, work_packages: list, entity_index: dict, job: "BackgroundJob"
+) -> Iterator:
     """"""
-    # Check if the line contains any graphic-related tags
-    if any(tag in line for tag in GRAPHIC_TAGS):
-        # Extract the board number from the line using regex
-        boardno = re.findall(r'boardno=[",\'][a-zA-Z0-9_-]+[",\']', line)
-        boardno = boardno[0][9:-1]
-        if boardno:
-            graphic = f"\t<!ENTITY {boardno} SYSTEM " f'"../graphics-SVG/{boardno}.svg" NDATA svg>'
-            if graphic not in new_graphics:
-                new_graphics.append(graphic)
-
-
-def process_external_entities(
-    line: str, ext_entity_dict: dict, new_external_entities: list
-) -> None:
-    """"""
-    if "&" in line:
-        # Find external entity references (e.g., &entity;)
-        matches = re.findall(r"&([a-zA-Z0-9._-]+);", line)
-
-        if matches:
-            # Since re.findall returns a list of matched entities, we iterate over them
-            for new_external_entity in matches:
-                entity_declaration = get_entity_declaration(new_external_entity, ext_entity_dict)
-                if entity_declaration:
-                    new_external_entities.append(entity_declaration)
+    # Write the work packages from the last scan instead of walking the folder again
+    job.total = len(work_packages)
+    with open_scan_cache(folder_path) as cache, profile_phase(job.profiler, "update"):
+        yield from update_work_packages(
+            work_packages, entity_index, cache, cancel=job.cancel, profiler=job.profiler
+        )
 
 
-def get_entity_declaration(new_external_entity: str, ext_entity_dict: dict) -> Optional[str]:
+def handle_update_item(job: "BackgroundJob", item: tuple) -> None:
     """"""
-    entity_mapping = {
-        "dimboil": (
-            "dim_boilerplate",
-            "../dtd/boilerplate/dimboil",
-            "-//USA-DOD//ENTITIES MIL-STD-40051 DIM Boilerplate REV D 7.0 20220130//EN",
-        ),
-        "editboil": (
-            "editable_boilerplate",
-            "../dtd/boilerplate/editboil",
-            "-//USA-DOD//ENTITIES MIL-STD-40051 Editable Boilerplate REV D 7.0 20220130//EN",
-        ),
-        "gimboil": (
-            "gim_boilerplate",
-            "../dtd/boilerplate/gimboil",
-            "-//USA-DOD//ENTITIES MIL-STD-40051 GIM Boilerplate REV D 7.0 20220130//EN",
-        ),
-        "mimboil": (
-            "mim_boilerplate",
-            "../dtd/boilerplate/mimboil",
-            "-//USA-DOD//ENTITIES MIL-STD-40051 MIM Boilerplate REV D 7.0 20220130//EN",
-        ),
-        "pimboil": (
-            "pim_boilerplate",
-            "../dtd/boilerplate/pimboil",
-            "-//USA-DOD//ENTITIES MIL-STD-40051 PIM Boilerplate REV D 7.0 20220130//EN",
-        ),
-        "prodboil": (
-            "prod_boilerplate",
-            "../dtd/boilerplate/prodboil",
-            "-//USA-DOD//ENTITIES MIL-STD-40051 PROD Boilerplate REV D 7.0 20220130//EN",
-        ),
-        "simboil": (
-            "sim_boilerplate",
-            "../dtd/boilerplate/simboil",
-            "-//USA-DOD//ENTITIES MIL-STD-40051 SIM Boilerplate REV D 7.0 20220130//EN",
-        ),
-        "cautions": (
-            "cautions",
-            "../entities/cautions",
-            "-//TRG//ENTITIES MIL-STD-40051 Cautions REV A 1.0 20241018//EN",
-        ),
-        "equipment_conditions": (
-            "equipment_conditions",
-            "../entities/equipment_conditions",
-            "-//TRG//ENTITIES MIL-STD-40051 Equipment Conditions REV A 1.0 20241018//EN",
-        ),
-        "followon_maintenance": (
-            "followon_maintenance",
-            "../entities/followon_maintenance",
-            "-//TRG//ENTITIES MIL-STD-40051 Follow-on Maintenance REV A 1.0 20241018//EN",
-        ),
-        "isb": (
-            "isb",
-            "../entities/isb",
-            "-//TRG//ENTITIES MIL-STD-40051 Initial Setup Box REV A 1.0 20241018//EN",
-        ),
-        "materials": (
-            "materials",
-            "../entities/materials",
-            "-//TRG//ENTITIES MIL-STD-40051 Material Parts REV A 1.0 20241018//EN",
-        ),
-        "material_replacement_parts": (
-            "material_replacement_parts",
-            "../entities/material_replacement_parts",
-            "-//TRG//ENTITIES MIL-STD-40051 Material Replacement Parts REV A 1.0 20241018//EN",
-        ),
-        "notes": (
-            "notes",
-            "../entities/notes",
-            "-//TRG//ENTITIES MIL-STD-40051 Notes REV A 1.0 20241018//EN",
-        ),
-        "personnel": (
-            "personnel",
-            "../entities/personnel",
-            "-//TRG//ENTITIES MIL-STD-40051 Personnel REV A 1.0 20241018//EN",
-        ),
-        "procedural_steps": (
-            "procedural_steps",
-            "../entities/procedural_steps",
-            "-//TRG//ENTITIES MIL-STD-40051 Procedural Steps REV A 1.0 20241018//EN",
-        ),
-        "references": (
-            "references",
-            "../entities/references",
-            "-//TRG//ENTITIES MIL-STD-40051 References REV A 1.0 20241018//EN",
-        ),
-        "special_tools": (
-            "special_tools",
-            "../entities/special_tools",
-            "-//TRG//ENTITIES MIL-STD-40051 Special Tools REV A 1.0 20241018//EN",
-        ),
-        "test_equipment": (
-            "test_equipment",
-            "../entities/test_equipment",
-            "-//TRG//ENTITIES MIL-STD-40051 Test Equipment REV A 1.0 20241018//EN",
-        ),
-        "tools": (
-            "tools",
-            "../entities/tools",
-            "-//TRG//ENTITIES MIL-STD-40051 Tools REV A 1.0 20241018//EN",
-        ),
-        "warnings": (
-            "warnings",
-            "../entities/warnings",
-            "-//TRG//ENTITIES MIL-STD-40051 Warnings REV A 1.0 20241018//EN",
-        ),
-        "warning_summary": (
-            "warning_summary",
-            "../entities/warning_summary",
-            "-//TRG//ENTITIES MIL-STD-40051 Warning Summary REV A 1.0 20241018//EN",
-        ),
-    }
+    status, work_package = item
+    job.result[status] += 1
+    # Keep the plan in step with the rewritten files
+    if work_package:
+        scan_results[work_package.path] = work_package
+        usage_index.add(work_package)
 
-    for key, value in entity_mapping.items():
-        try:
-            if new_external_entity in ext_entity_dict[key]:
-                entity_name, filename, public_id = value
 
-                return (
-                    f'\t<!ENTITY % {entity_name} PUBLIC "{public_id}" '
-                    f'"{filename}.ent"> %{entity_name};'
-                )
-        except KeyError:
-            # If the entity file is not found in the dictionary, skip to the next entity file
-            continue
-
-    return None
+def finish_update(job: "BackgroundJob") -> None:
+    """"""
+    status_counts = (
+        f"Written: {job.result[WRITTEN]}\n"
+        f"Unchanged: {job.result[UNCHANGED]}\n"
+        f"Skipped: {job.result[SKIPPED]}"
+    )
+    if job.error:
+        messagebox.showerror("ERROR", f"The update failed:\n\n{job.error}\n\n{status_counts}")
+    elif job.cancel.is_set():
+        messagebox.showinfo("CANCELLED", f"The update was cancelled.\n\n{status_counts}")
+    else:
+        # Display a success message
+        messagebox.showinfo("SUCCESS", f"Files converted successfully\n\n{status_counts}")
 
 
-def get_external_entities_from_ent_file(entity_file: list[str]) -> list:
+def export_manifest() -> None:
     """"""
-    external_entities = []
-    for line in entity_file:
-        if "<!ENTITY" in line:
-            external_entity = re.findall(r"<!ENTITY [a-zA-Z0-9._-]+", line)
+    if BackgroundJob.current is not None:
+        return
+    filename = filedialog.asksaveasfilename(
+        defaultextension=".jsonl",
+        filetypes=[("JSON Lines", "*.jsonl"), ("CSV", "*.csv")],
+    )
+    if not filename:
+        return
 
-            if external_entity and external_entity not in external_entities:
-                external_entity = external_entity[0][9:]
-                external_entities.append(external_entity)
-    return external_entities
+    job = BackgroundJob(
+        functools.partial(
+            write_manifest, Path(filename), list(scan_results.values()), entity_index, FOLDER_PATH
+        ),
+        lambda job, item: None,
+        finish_export,
+    )
+    job.result = Path(filename)
+    job.start()
 
 
-def print_doctype_declaration(path: Path) -> None:
+def write_manifest(
+    manifest_path: Path,
+    work_packages: list,
+    entity_index: dict,
+    folder_path: Path,
+    job: "BackgroundJob",
+) -> Iterator:
+    """"""
+    # Each record is written as soon as it is rendered instead of building the file in memory
+    job.total = len(work_packages)
+    with manifest_path.open("w", encoding="utf-8", newline="") as stream:
+        manifest = ManifestWriter(stream, get_manifest_format(manifest_path))
+        for work_package in work_packages:
+            if job.cancel.is_set():
+                return
+            manifest.write(get_manifest_record(work_package, entity_index, folder_path))
+            yield work_package
+
+
+def finish_export(job: "BackgroundJob") -> None:
     """"""
-    opening_tag = get_opening_tag(path)
-    if opening_tag:
-        doctype_tag_end = (
-            'PUBLIC "-//USA-DOD//DTD -1/2D TM Assembly REV D 7.0 20220130//EN" '
-            '"../dtd/40051D_7_0.dtd" ['
+    if job.error:
+        messagebox.showerror("ERROR", f"The export failed:\n\n{job.error}")
+    elif job.cancel.is_set():
+        messagebox.showinfo(
+            "CANCELLED", f"The export was cancelled.\n\n{job.result} is incomplete."
         )
-        # Print Opening Caret in aqua
-        textbox.tag_configure("aqua", foreground="aqua", font="Monaco")
-        textbox.insert(END, "<!", "aqua")
-        # Print DOCTYPE in lavender
-        textbox.tag_configure("lavender", foreground="lavender", font="Monaco")
-        textbox.insert(END, "DOCTYPE ", "lavender")
-        # Print opening tag in red
-        textbox.tag_configure("red", foreground="red", font="Monaco")
-        textbox.insert(END, f"{opening_tag}", "red")
-        # Print Public ID and DTD path in aqua
-        textbox.tag_configure("aqua", foreground="aqua", font="Monaco")
-        textbox.insert(END, " " + doctype_tag_end + "\n", "aqua")
+    else:
+        messagebox.showinfo("SUCCESS", f"Manifest written to {job.result}")
 
 
-def get_opening_tag(path: Path) -> Optional[str]:
+def toggle_watch() -> None:
     """"""
-    with open(path, "r", encoding="utf-8") as work_package:
-        lines = work_package.read().splitlines(True)
-        opening_tag = None  # Initialize opening_tag to None
-
-        for line in lines:
-            if (
-                line.startswith("<")
-                and not line.startswith("<?xml")
-                and not line.startswith("<!")
-                and not line.startswith("</")
-            ):
-                opening_tag = re.findall(r"([a-zA-Z._-]+)", line)[0]
-                # print(opening_tag)
-                break
-
-    # Check if the line contains any chapter-related tags
-    if (
-        opening_tag
-        and len(opening_tag) >= 2
-        and not any(chap_tag in line for chap_tag in CHAPTER_TAGS)
-    ):
-        return opening_tag
-    else:
-        # logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
-        # logging.info("No valid opening tag found in %s.", path)
-        return None
+    stop_watching()
+    # Watching starts from a scanned project; otherwise it starts when the next scan finishes
+    if watch_var.get() and scan_results and BackgroundJob.current is None:
+        start_watching(FOLDER_PATH)
 
 
-def update_files_in_background() -> None:
+def start_watching(folder_path: Path) -> None:
     """"""
-    thread = threading.Thread(target=update_files(FOLDER_PATH, ext_entity_dict))
-    thread.start()
+    global watch_stop  # pylint: disable=W0603
+    stop_watching()
+    watch_stop = threading.Event()
+    threading.Thread(target=watch_project, args=(folder_path, watch_stop), daemon=True).start()
 
 
-def update_files(folder_path: Path, ext_entity_dict: dict) -> None:
+def stop_watching() -> None:
     """"""
-    doctype_end = "]>"
-    xml_tag = '<?xml version="1.0" encoding="UTF-8"?>'
-
-    # Create a progress bar
-    progress_bar = ttk.Progressbar(root, orient="horizontal", length=300, mode="determinate")
-    progress_bar.pack(pady=20)
-
-    # Get a list of all XML files to be processed
-    xml_files = [
-        path
-        for path in folder_path.rglob("files/*.xml")
-        if not any(term in path.name.lower() for term in files_to_skip)
-        # and "!submission" not in str(path).lower()
-    ]
-    max_value = len(xml_files)
-
-    # Set the maximum value for the progress bar
-    progress_bar["maximum"] = max_value
-    progress_bar["value"] = 0  # Reset the progress bar value
-
-    # Iterate through all XML files and process them
-    for i, path in enumerate(xml_files, start=1):
-        process_file(path, xml_tag, doctype_end, ext_entity_dict)
-        # # Measure the time taken for 10 executions of scan_iads_folder
-        # execution_time: float = timeit.timeit(
-        #     "process_file(path, xml_tag, doctype_end, ext_entity_dict)",
-        #     globals=globals(),
-        #     number=10,
-        # )
-        # logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
-        # logging.info("Execution time: %s seconds", execution_time)
-        progress_bar["value"] = i  # Update progress bar value
-        root.update_idletasks()  # Update the GUI
-
-    # Job is done; now hide the progress bar
-    progress_bar.pack_forget()
-
-    # Display a success message
-    messagebox.showinfo("SUCCESS", "Files converted successfully")
-
-
-def should_skip_file(path: Path) -> bool:
-    """"""
-    return any(term in path.name.lower() for term in files_to_skip)
+    global watch_stop  # pylint: disable=W0603
+    if watch_stop:
+        watch_stop.set()
+        watch_stop = None
 
 
-def process_file(path: Path, xml_tag: str, doctype_end: str, ext_entity_dict: dict) -> None:
+def watch_project(folder_path: Path, stop: threading.Event) -> None:
     """"""
-    new_graphics, new_external_entities = extract_entities(path, ext_entity_dict)
-    doctype_start = (
-        f"<!DOCTYPE {get_opening_tag(path)} PUBLIC "
-        f'"-//USA-DOD//DTD -1/2D TM Assembly REV D 7.0 20220130//EN" '
-        f'"../dtd/40051D_7_0.dtd" ['
-    )
+    # Runs on the watcher thread, with its own connection to the scan cache
+    with open_scan_cache(folder_path) as cache:
+        watcher = ProjectWatcher(folder_path, cache)
+        with contextlib.suppress(OSError):
+            # Catch up with the scan that started the watch; it's already on screen
+            watcher.poll()
+
+        while not stop.wait(WATCH_INTERVAL):
+            try:
+                changes = watcher.poll()
+            except OSError:
+                # A share that drops out for a moment is polled again next time
+                continue
+            if changes.work_packages or changes.removed:
+                previews = [
+                    (
+                        work_package,
+                        get_preview_segments(work_package, watcher.entity_index, watcher.graphics),
+                    )
+                    for work_package in changes.work_packages
+                ]
+                watch_queue.put(
+                    (stop, dict(watcher.entity_index), watcher.graphics, previews, changes.removed)
+                )
 
-    # logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
-    # logging.info("Opening %s.", path)
 
-    # Read the work package file
-    with path.open("r", encoding="utf-8") as fin:
-        work_package = fin.read().splitlines(True)
+def drain_watch_queue() -> None:
+    """"""
+    # Runs on the Tk main loop: apply what the watcher found since the last poll
+    global entity_index, graphics_index  # pylint: disable=W0603
+    changed = False
+    while True:
+        try:
+            stop, new_entity_index, graphics, previews, removed = watch_queue.get_nowait()
+        except queue.Empty:
+            break
+        # Ignore what a watch found after it was stopped
+        if stop is not watch_stop:
+            continue
 
-    # Write the updated content to the file
-    write_updated_file(
-        path, work_package, xml_tag, doctype_start, doctype_end, new_graphics, new_external_entities
-    )
+        entity_index, graphics_index = new_entity_index, graphics
+        for path in removed:
+            scan_results.pop(path, None)
+            usage_index.remove(path)
+            preview.remove(path)
+        for work_package, segments in previews:
+            scan_results[work_package.path] = work_package
+            usage_index.add(work_package)
+            preview.set(work_package.path, segments)
+        changed = True
 
+    if changed:
+        preview.refresh()
+    root.after(WATCH_DRAIN_MS, drain_watch_queue)
 
-def extract_entities(path: Path, ext_entity_dict: dict) -> tuple[list[str], list[str]]:
-    """"""
-    new_graphics = []
-    new_external_entities = []
-
-    with path.open("r", encoding="utf-8") as fin:
-        work_package = fin.read().splitlines(True)
-
-    for line in work_package:
-        # Extract graphics-related entities
-        if is_graphic_line(line):
-            boardno = re.findall(r'boardno=[",\'][a-zA-Z0-9_-]+[",\']', line)
-            boardno = boardno[0][9:-1]
-            if boardno:
-                graphic = (
-                    f"\t<!ENTITY {boardno} SYSTEM "
-                    f'"../graphics-SVG/{boardno}.svg"'
-                    f" NDATA svg>"
-                )
-                new_graphics.append(graphic)
 
-        # Extract external entity references
-        if "&" in line:
-            matches = re.findall(r"&([a-zA-Z0-9._-]+);", line)
+def show_usage() -> None:
+    """"""
+    pattern = search_var.get().strip()
+    if not pattern:
+        return
+    # Plain text matches anywhere in the name; wildcards are passed through as typed
+    if not any(character in pattern for character in "*?["):
+        pattern = f"*{pattern}*"
+    matches = usage_index.find(pattern)
+
+    window = ttk.Toplevel(title=f"Who uses {search_var.get().strip()}")
+    window.geometry("700x500")
+    results = st.ScrolledText(window, font=("Monaco", 12), wrap=WORD)
+    results.pack(fill=BOTH, expand=True, padx=10, pady=10)
+    if not matches:
+        results.insert(END, "No scanned work package uses this name.")
+    for name, paths in matches.items():
+        results.insert(END, f"{name}\n", "path")
+        results.insert(END, "".join(f"\t{path.name}\n" for path in paths))
+    results.tag_configure("path", font=("Arial", 12, "bold"))
+    results.configure(state=DISABLED)
+
+
+def get_job_profiler(folder_path: Path) -> Optional[Profiler]:
+    """"""
+    if not profile_var.get():
+        return None
+    # Without IADS_PROFILE, the report is kept next to the project's scan cache
+    return get_profiler_from_env() or Profiler(
+        get_cache_path(folder_path).with_suffix(".profile.json")
+    )
 
-            for new_external_entity in matches:
-                entity_declaration = get_entity_declaration(new_external_entity, ext_entity_dict)
-                if entity_declaration:
-                    new_external_entities.append(entity_declaration)
 
-    return new_graphics, new_external_entities
+def cancel_job() -> None:
+    """"""
+    if BackgroundJob.current:
+        BackgroundJob.current.cancel.set()
+        cancel_btn.configure(state=DISABLED)
 
 
-def is_graphic_line(line: str) -> bool:
+class BackgroundJob:
     """"""
-    return any(tag in line for tag in GRAPHIC_TAGS)
-
-
-def write_updated_file(
-    path: Path,
-    work_package: list[str],
-    xml_tag: str,
-    doctype_start: str,
-    doctype_end: str,
-    new_graphics: list[str],
-    new_external_entities: list[str],
-) -> None:
+
+    current: Optional["BackgroundJob"] = None
+
+    def __init__(
+        self,
+        work: Callable,
+        handle_item: Callable,
+        finish: Callable,
+        profiler: Optional[Profiler] = None,
+    ) -> None:
+        """"""
+        self.work = work
+        self.handle_item = handle_item
+        self.finish = finish
+        self.profiler = profiler
+        self.cancel = threading.Event()
+        self.work_queue = queue.Queue(maxsize=WORK_QUEUE_SIZE)
+        self.result = None
+        self.error = None
+        self.done = 0
+        self.total = 0
+        self.next_progress = 0.0
+
+    def start(self) -> None:
+        """"""
+        # One job at a time: the cancel button and the shared results belong to the current one
+        if BackgroundJob.current is not None:
+            return
+        BackgroundJob.current = self
+        for button in (iads_btn, update_btn, export_btn):
+            button.configure(state=DISABLED)
+        cancel_btn.configure(state=NORMAL)
+        progress_bar["value"] = 0  # Reset the progress bar value
+        progress_bar.pack(pady=10)
+
+        threading.Thread(target=self.run, daemon=True).start()
+        root.after(QUEUE_POLL_MS, self.drain)
+
+    def run(self) -> None:
+        """"""
+        # Runs on the worker thread: results only ever reach Tk through the queue
+        try:
+            with self.profiler.profile() if self.profiler else contextlib.nullcontext():
+                for item in self.work(self):
+                    self.work_queue.put(item)
+        except Exception as error:  # pylint: disable=broad-except
+            self.error = error
+        self.work_queue.put(JOB_FINISHED)
+
+    def drain(self) -> None:
+        """"""
+        # Runs on the Tk main loop: apply what the worker queued since the last poll
+        finished = False
+        for _ in range(WORK_QUEUE_SIZE):
+            try:
+                item = self.work_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is JOB_FINISHED:
+                finished = True
+                break
+            self.done += 1
+            self.handle_item(self, item)
+
+        # Redraw the progress bar at a fixed rate, however fast results arrive
+        now = time.monotonic()
+        if finished or now >= self.next_progress:
+            progress_bar["maximum"] = max(self.total, 1)
+            progress_bar["value"] = self.done
+            self.next_progress = now + PROGRESS_INTERVAL_MS / 1000
+        with profile_phase(self.profiler, "tk_render"):
+            preview.flush()
+
+        if not finished:
+            root.after(QUEUE_POLL_MS, self.drain)
+            return
+
+        # Job is done; now hide the progress bar and hand the controls back
+        BackgroundJob.current = None
+        progress_bar.pack_forget()
+        iads_btn.configure(state=NORMAL)
+        cancel_btn.configure(state=DISABLED)
+        if self.profiler:
+            print(self.profiler.finish())
+            print(f"Profile report: {self.profiler.report_path}")
+        self.finish(self)
+        # Only the results of a finished scan can be written back or exported
+        for button in (update_btn, export_btn):
+            button.configure(state=NORMAL if scan_complete else DISABLED)
+
+
+class PreviewPane:
     """"""
-    with path.open("w", encoding="utf-8") as fout:
-        # If the file isn't empty, update the file
-        if "None" not in doctype_start:
-            # Write the XML tag and DOCTYPE start
-            fout.write(f"{xml_tag}\n{doctype_start}\n")
-            total_entities = list(itertools.chain(new_graphics, new_external_entities))
-            sorted_entities = sorted(set(total_entities))
-
-            for entity in sorted_entities:
-
-                # Add the selectboil entity declaration if editboil entity is found
-                if "edit" in entity:
-                    selectboil: str = (
-                        '\t<!ENTITY % select_boilerplate PUBLIC "-//USA-DOD//ENTITIES MIL-STD-40051 Selection Boilerplate REV D 7.0 20220130//EN" '
-                        '"../dtd/boilerplate/selectboil.ent"> %select_boilerplate;'
-                    )
-                    fout.write(f"{selectboil}\n")
-                    fout.write(f"{entity}\n")
-                else:
-                    fout.write(f"{entity}\n")
-            fout.write(f"{doctype_end}\n")
 
-            # Write the remaining part of the file (excluding the old DOCTYPE)
-            found_doctype_end = False
+    def __init__(self, textbox, page_label, previous_btn, next_btn) -> None:
+        """"""
+        self.textbox = textbox
+        self.page_label = page_label
+        self.previous_btn = previous_btn
+        self.next_btn = next_btn
+        self.page = 0
+        # Insert arguments for every previewed work package by path, and those not yet shown
+        self.work_packages = {}
+        self.pending = []
+
+    def clear(self) -> None:
+        """"""
+        self.page = 0
+        self.work_packages = {}
+        self.pending = []
+        self.textbox.delete("1.0", END)
+        self.flush()
+
+    def add(self, path: Path, segments: list) -> None:
+        """"""
+        self.work_packages[path] = segments
+        # Only work packages on the visible page are materialized in the text box
+        if (len(self.work_packages) - 1) // PREVIEW_PAGE_SIZE == self.page:
+            self.pending.extend(segments)
+
+    def set(self, path: Path, segments: list) -> None:
+        """"""
+        # Replaced or added by the watcher; shown on the next refresh
+        self.work_packages[path] = segments
+
+    def remove(self, path: Path) -> None:
+        """"""
+        self.work_packages.pop(path, None)
+
+    def refresh(self) -> None:
+        """"""
+        # Redraw the visible page where the reader left it
+        position = self.textbox.yview()[0]
+        self.show_page(self.page)
+        self.textbox.yview_moveto(position)
+
+    def page_count(self) -> int:
+        """"""
+        return max(1, -(-len(self.work_packages) // PREVIEW_PAGE_SIZE))
+
+    def show_page(self, page: int) -> None:
+        """"""
+        self.page = max(0, min(page, self.page_count() - 1))
+        start = self.page * PREVIEW_PAGE_SIZE
+        page_segments = itertools.islice(
+            self.work_packages.values(), start, start + PREVIEW_PAGE_SIZE
+        )
+        self.pending = [argument for segments in page_segments for argument in segments]
+        self.textbox.delete("1.0", END)
+        self.flush()
 
-            for line in work_package:
-                if not found_doctype_end:
-                    if doctype_end in line:
-                        found_doctype_end = True
-                    continue  # Skip lines until DOCTYPE end is found
+    def flush(self) -> None:
+        """"""
+        # One insert call for everything queued since the last flush
+        if self.pending:
+            self.textbox.insert(END, *self.pending)
+            self.pending = []
 
-                fout.write(line)
+        page_count = self.page_count()
+        self.page_label.configure(text=f"Page {self.page + 1} of {page_count}")
+        self.previous_btn.configure(state=NORMAL if self.page > 0 else DISABLED)
+        self.next_btn.configure(state=NORMAL if self.page < page_count - 1 else DISABLED)
 
 
 def resource_path(relative_path: str) -> Path:
@@ -655,7 +652,7 @@ frame_btm.pack(side=BOTTOM, fill=BOTH, expand=True, padx=10, pady=10)
 iads_btn = ttk.Button(
     frame_top,
     text="Open IADS Folder",
-    command=scan_folder_in_background,
+    command=open_iads_dir,
     style=CUSTOM_TBUTTON,
 )
 iads_btn.grid(row=0, column=0, padx=(0, 5), pady=5, sticky=W)
@@ -670,14 +667,64 @@ update_btn = ttk.Button(
 )
 update_btn.grid(row=0, column=1, padx=5, pady=5, sticky=W)
 
+# "EXPORT MANIFEST" button to save the last scan as JSON Lines or CSV
+export_btn = ttk.Button(
+    frame_top,
+    text="Export Manifest",
+    command=export_manifest,
+    state=DISABLED,
+    style=CUSTOM_TBUTTON,
+)
+export_btn.grid(row=0, column=2, padx=5, pady=5, sticky=W)
+
+# "CANCEL" button to stop a running scan or update
+cancel_btn = ttk.Button(
+    frame_top,
+    text="Cancel",
+    command=cancel_job,
+    state=DISABLED,
+    style=CUSTOM_TBUTTON,
+)
+cancel_btn.grid(row=0, column=3, padx=5, pady=5, sticky=W)
+
+# Buttons and label to page through the preview of large projects
+previous_btn = ttk.Button(
+    frame_top, text="<", command=lambda: preview.show_page(preview.page - 1), state=DISABLED
+)
+previous_btn.grid(row=0, column=4, padx=(15, 5), pady=5, sticky=W)
+page_label = ttk.Label(frame_top, text="Page 1 of 1")
+page_label.grid(row=0, column=5, padx=5, pady=5, sticky=W)
+next_btn = ttk.Button(
+    frame_top, text=">", command=lambda: preview.show_page(preview.page + 1), state=DISABLED
+)
+next_btn.grid(row=0, column=6, padx=5, pady=5, sticky=W)
+
+# Toggle to record per-phase timings of the next scan or update (on if IADS_PROFILE is set)
+profile_var = ttk.BooleanVar(value=get_profiler_from_env() is not None)
+profile_check = ttk.Checkbutton(frame_top, text="Profile", variable=profile_var)
+profile_check.grid(row=0, column=7, padx=(15, 5), pady=5, sticky=W)
+
+# Toggle to keep the preview in step with edits to the project after a scan
+watch_var = ttk.BooleanVar(value=False)
+watch_check = ttk.Checkbutton(frame_top, text="Watch", variable=watch_var, command=toggle_watch)
+watch_check.grid(row=0, column=8, padx=5, pady=5, sticky=W)
+
+# Search box listing the work packages that use an entity or graphic
+search_var = ttk.StringVar()
+search_entry = ttk.Entry(frame_top, textvariable=search_var, width=24)
+search_entry.grid(row=0, column=9, padx=(15, 5), pady=5, sticky=W)
+search_entry.bind("<Return>", lambda _: show_usage())
+search_btn = ttk.Button(frame_top, text="Who Uses", command=show_usage)
+search_btn.grid(row=0, column=10, padx=5, pady=5, sticky=W)
+
 # Add empty space between buttons and the image
-frame_top.columnconfigure(2, weight=1)
+frame_top.columnconfigure(11, weight=1)
 
 # Label to display the image on the far right
 img_label = ttk.Label(frame_top, image=img)  # type: ignore
 # Keep a reference to avoid garbage collection
 img_label.image = img  # type: ignore
-img_label.grid(row=0, column=3, padx=0, pady=5, sticky=E)
+img_label.grid(row=0, column=12, padx=0, pady=5, sticky=E)
 
 # ScrolledText widget for log output or entity text display
 textbox = st.ScrolledText(
@@ -693,5 +740,20 @@ font = tkfont.Font(font=textbox["font"])
 tab = font.measure("    ")  # Measure the size of 4 spaces
 textbox.configure(tabs=tab)
 
+# Configure the preview tags once instead of on every insert
+textbox.tag_configure("path", font=("Arial", 12, "bold"))
+textbox.tag_configure("aqua", foreground="aqua", font="Monaco")
+textbox.tag_configure("lavender", foreground="lavender", font="Monaco")
+textbox.tag_configure("red", foreground="red", font="Monaco")
+
+# Preview output is batched into the text box whenever a background job is polled
+preview = PreviewPane(textbox, page_label, previous_btn, next_btn)
+
+# Progress bar shown while a scan or update is running
+progress_bar = ttk.Progressbar(root, orient="horizontal", length=300, mode="determinate")
+
+# Apply changes found while watching the project
+root.after(WATCH_DRAIN_MS, drain_watch_queue)
+
 # Start the main event loop
 root.mainloop()
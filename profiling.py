@@ -0,0 +1,177 @@
+"""IADS ENTITY SCANNER PROFILING"""
+
+import contextlib
+import cProfile
+import functools
+import heapq
+import json
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, Optional
+
+# Environment variables that turn profiling on without touching the CLI or GUI
+CPROFILE_ENV = "IADS_CPROFILE"
+PROFILE_ENV = "IADS_PROFILE"
+# Files listed in the report as the slowest ones
+SLOWEST_FILES = 10
+
+
+@dataclass
+class PhaseStats:
+    """"""
+
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    # Seconds spent on the phase's files, summed over the workers that handled them
+    file_seconds: float = 0.0
+    files: int = 0
+    bytes: int = 0
+
+
+class Profiler:
+    """"""
+
+    def __init__(
+        self,
+        report_path: Optional[Path] = None,
+        cprofile_path: Optional[Path] = None,
+        slowest_files: int = SLOWEST_FILES,
+    ) -> None:
+        """"""
+        self.report_path = report_path
+        self.cprofile_path = cprofile_path
+        self.slowest_files = slowest_files
+        self.phases = {}
+        # Min-heap of (seconds, path, phase, size) holding the slowest files seen so far
+        self.slowest = []
+        self.lock = threading.Lock()
+        self.cprofile = cProfile.Profile() if cprofile_path else None
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """"""
+        # CPU time is for the whole process, so it includes the worker threads of the phase
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            with self.lock:
+                stats = self.phases.setdefault(name, PhaseStats())
+                stats.wall_seconds += wall
+                stats.cpu_seconds += cpu
+
+    def add_file(
+        self, phase: str, path: Path, seconds: float, size: int, ranked: bool = True
+    ) -> None:
+        """"""
+        # Parts of another phase's file (e.g. its read) aren't ranked against whole files
+        with self.lock:
+            stats = self.phases.setdefault(phase, PhaseStats())
+            stats.file_seconds += seconds
+            stats.files += 1
+            stats.bytes += size
+            if not ranked:
+                return
+
+            entry = (seconds, str(path), phase, size)
+            if len(self.slowest) < self.slowest_files:
+                heapq.heappush(self.slowest, entry)
+            elif self.slowest and entry > self.slowest[0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    @contextlib.contextmanager
+    def profile(self):
+        """"""
+        # cProfile only sees the thread that enables it, i.e. not the scan workers
+        if self.cprofile is None:
+            yield
+            return
+        self.cprofile.enable()
+        try:
+            yield
+        finally:
+            self.cprofile.disable()
+
+    def report(self) -> dict:
+        """"""
+        with self.lock:
+            return {
+                "phases": {name: asdict(stats) for name, stats in self.phases.items()},
+                "slowest_files": [
+                    {"path": path, "phase": phase, "seconds": seconds, "bytes": size}
+                    for seconds, path, phase, size in sorted(self.slowest, reverse=True)
+                ],
+            }
+
+    def summary(self) -> str:
+        """"""
+        report = self.report()
+        lines = ["Phase                 Wall (s)   CPU (s)  File (s)    Files        Bytes"]
+        for name, stats in report["phases"].items():
+            lines.append(
+                f"{name:<20} {stats['wall_seconds']:>9.3f} {stats['cpu_seconds']:>9.3f} "
+                f"{stats['file_seconds']:>9.3f} {stats['files']:>8} {stats['bytes']:>12}"
+            )
+        if report["slowest_files"]:
+            lines.append("Slowest files:")
+            lines.extend(
+                f"  {entry['seconds']:.4f}s {entry['phase']} {entry['path']}"
+                for entry in report["slowest_files"]
+            )
+        return "\n".join(lines)
+
+    def finish(self) -> str:
+        """"""
+        # Write the JSON report and the cProfile dump, if asked for, and return the summary
+        if self.report_path:
+            Path(self.report_path).parent.mkdir(parents=True, exist_ok=True)
+            Path(self.report_path).write_text(
+                json.dumps(self.report(), indent=2) + "\n", encoding="utf-8"
+            )
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(self.cprofile_path)
+        return self.summary()
+
+
+def get_profiler_from_env() -> Optional[Profiler]:
+    """"""
+    report_path = os.environ.get(PROFILE_ENV)
+    cprofile_path = os.environ.get(CPROFILE_ENV)
+    if not report_path and not cprofile_path:
+        return None
+    return Profiler(report_path or None, cprofile_path or None)
+
+
+def profile_phase(profiler: Optional[Profiler], name: str):
+    """"""
+    return profiler.phase(name) if profiler else contextlib.nullcontext()
+
+
+def timed(function: Callable, profiler: Optional[Profiler]) -> Callable:
+    """"""
+    # Worker processes can't reach the profiler, so the timing travels back with the result
+    if profiler is None:
+        return function
+    return functools.partial(call_timed, function)
+
+
+def call_timed(function: Callable, item) -> tuple:
+    """"""
+    start = time.perf_counter()
+    result = function(item)
+    return time.perf_counter() - start, result
+
+
+def record_timed(profiler: Optional[Profiler], phase: str, path: Path, item, size: Callable):
+    """"""
+    # Unwrap a result of a timed() call and record it against its file
+    if profiler is None:
+        return item
+    seconds, result = item
+    if result is not None:
+        profiler.add_file(phase, path, seconds, size(result))
+    return result
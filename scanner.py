@@ -0,0 +1,1477 @@
+"""IADS ENTITY SCANNER CORE"""
+
+import collections
+import contextlib
+import csv
+import fnmatch
+import functools
+import hashlib
+import itertools
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field, replace
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterator, Optional, TextIO
+
+from profiling import Profiler, call_timed, record_timed, timed
+
+# Cache entries written before committing, so a long-lived watcher never blocks other processes
+CACHE_COMMIT_SIZE = 256
+# Bump whenever the cached work package analysis changes shape or meaning
+CACHE_VERSION = 7
+CHAPTER_TAGS = (
+    "gim",
+    "opim",
+    "tim",
+    "mim",
+    "dim",
+    "pim",
+    "sim",
+    "paper.manual",
+    "production",
+)
+# Block size for copying work package bodies where the kernel can't do it for us
+COPY_BUFFER_SIZE = 1024 * 1024
+DOCTYPE_END = "]>"
+DOCTYPE_TAG_END = (
+    'PUBLIC "-//USA-DOD//DTD -1/2D TM Assembly REV D 7.0 20220130//EN" "../dtd/40051D_7_0.dtd" ['
+)
+files_to_skip = (
+    "chap",
+    "start",
+    "submission",
+    "production",
+    "catalog",
+    "entity",
+    "dataset",
+    "toc",
+    "999",
+)
+# Folder holding the SVG graphics referenced by boardno
+GRAPHICS_DIR = "graphics-svg"
+GRAPHIC_TAGS = ("<graphic ", "<icon-set ", "<symbol ", "<authent ", "<back ")
+# General entity declarations, which may span lines or share one (parameter entities start with %),
+# with the replacement text of internal ones
+ENTITY_DECLARATION_PATTERN = re.compile(
+    r"<!ENTITY\s+([a-zA-Z0-9._-]+)(?:\s+(?:\"([^\"]*)\"|'([^']*)'))?"
+)
+# Characters read from an entity file at a time
+ENTITY_READ_SIZE = 64 * 1024
+# Entity references in replacement text
+ENTITY_REFERENCE_PATTERN = re.compile(r"&([a-zA-Z0-9._-]+);")
+# Graphic elements with their board number, or external entity references (e.g., &entity;)
+# The board number is matched ahead so references in the graphic's other attributes still count
+ENTITY_SCAN_PATTERN = re.compile(
+    r"<(?:%s)\s(?=[^>]*?\bboardno\s*=\s*[\"']([a-zA-Z0-9_-]+)[\"'])|&([a-zA-Z0-9._-]+);"
+    % "|".join(re.escape(tag[1:].strip()) for tag in GRAPHIC_TAGS)
+)
+# Bytes read from the top of a work package before looking for its opening tag
+HEADER_READ_SIZE = 4096
+# Columns of a CSV manifest, which are also the keys of each JSON Lines record
+MANIFEST_FIELDS = ("path", "root_tag", "graphics", "declarations", "unresolved", "scan_seconds")
+PROLOG_PATTERN = re.compile(
+    rb"\s*(?:(?P<xml><\?xml\b.*?\?>)|<\?.*?\?>|<!--.*?-->"
+    rb"|(?P<doctype><!DOCTYPE\b[^\[>]*(?:\[.*?\]\s*)?>))",
+    re.DOTALL,
+)
+# Output folders skipped while walking a project (besides "!", hidden and non-SVG graphics)
+PRUNED_DIRS = ("output", "pdf")
+# Bytes of finished reads the read-ahead may hold before it waits for the analysis to catch up
+READ_AHEAD_BYTES = 64 * 1024 * 1024
+# First line that opens an element, skipping the XML declaration, DOCTYPE, comments and closes
+ROOT_LINE_PATTERN = re.compile(rb"^<(?!\?xml|!|/)[^\r\n]*", re.MULTILINE)
+# Worker threads and files per task used to analyze and rewrite work packages
+SCAN_CHUNK_SIZE = 16
+SCAN_JOBS = min(32, (os.cpu_count() or 1) + 4)
+# Work packages looked up in the cache and analyzed per batch, which bounds the memory of a scan
+SCAN_WINDOW_SIZE = 4096
+# Outcomes of updating a single work package
+SKIPPED = "skipped"
+UNCHANGED = "unchanged"
+WRITTEN = "written"
+UTF8_BOM = b"\xef\xbb\xbf"
+# Seconds between two polls of a watched project
+WATCH_INTERVAL = 2.0
+# Entities every XML parser knows, which never need a declaration
+XML_ENTITIES = ("amp", "apos", "gt", "lt", "quot")
+XML_TAG = '<?xml version="1.0" encoding="UTF-8"?>'
+
+# Entity files that may be declared in a work package DOCTYPE, in lookup priority order
+ENTITY_FILES = {
+    "dimboil": (
+        "dim_boilerplate",
+        "../dtd/boilerplate/dimboil",
+        "-//USA-DOD//ENTITIES MIL-STD-40051 DIM Boilerplate REV D 7.0 20220130//EN",
+    ),
+    "editboil": (
+        "editable_boilerplate",
+        "../dtd/boilerplate/editboil",
+        "-//USA-DOD//ENTITIES MIL-STD-40051 Editable Boilerplate REV D 7.0 20220130//EN",
+    ),
+    "gimboil": (
+        "gim_boilerplate",
+        "../dtd/boilerplate/gimboil",
+        "-//USA-DOD//ENTITIES MIL-STD-40051 GIM Boilerplate REV D 7.0 20220130//EN",
+    ),
+    "mimboil": (
+        "mim_boilerplate",
+        "../dtd/boilerplate/mimboil",
+        "-//USA-DOD//ENTITIES MIL-STD-40051 MIM Boilerplate REV D 7.0 20220130//EN",
+    ),
+    "pimboil": (
+        "pim_boilerplate",
+        "../dtd/boilerplate/pimboil",
+        "-//USA-DOD//ENTITIES MIL-STD-40051 PIM Boilerplate REV D 7.0 20220130//EN",
+    ),
+    "prodboil": (
+        "prod_boilerplate",
+        "../dtd/boilerplate/prodboil",
+        "-//USA-DOD//ENTITIES MIL-STD-40051 PROD Boilerplate REV D 7.0 20220130//EN",
+    ),
+    "selectboil": (
+        "select_boilerplate",
+        "../dtd/boilerplate/selectboil",
+        "-//USA-DOD//ENTITIES MIL-STD-40051 Selection Boilerplate REV D 7.0 20220130//EN",
+    ),
+    "simboil": (
+        "sim_boilerplate",
+        "../dtd/boilerplate/simboil",
+        "-//USA-DOD//ENTITIES MIL-STD-40051 SIM Boilerplate REV D 7.0 20220130//EN",
+    ),
+    "cautions": (
+        "cautions",
+        "../entities/cautions",
+        "-//TRG//ENTITIES MIL-STD-40051 Cautions REV A 1.0 20241018//EN",
+    ),
+    "equipment_conditions": (
+        "equipment_conditions",
+        "../entities/equipment_conditions",
+        "-//TRG//ENTITIES MIL-STD-40051 Equipment Conditions REV A 1.0 20241018//EN",
+    ),
+    "followon_maintenance": (
+        "followon_maintenance",
+        "../entities/followon_maintenance",
+        "-//TRG//ENTITIES MIL-STD-40051 Follow-on Maintenance REV A 1.0 20241018//EN",
+    ),
+    "isb": (
+        "isb",
+        "../entities/isb",
+        "-//TRG//ENTITIES MIL-STD-40051 Initial Setup Box REV A 1.0 20241018//EN",
+    ),
+    "materials": (
+        "materials",
+        "../entities/materials",
+        "-//TRG//ENTITIES MIL-STD-40051 Material Parts REV A 1.0 20241018//EN",
+    ),
+    "material_replacement_parts": (
+        "material_replacement_parts",
+        "../entities/material_replacement_parts",
+        "-//TRG//ENTITIES MIL-STD-40051 Material Replacement Parts REV A 1.0 20241018//EN",
+    ),
+    "notes": (
+        "notes",
+        "../entities/notes",
+        "-//TRG//ENTITIES MIL-STD-40051 Notes REV A 1.0 20241018//EN",
+    ),
+    "personnel": (
+        "personnel",
+        "../entities/personnel",
+        "-//TRG//ENTITIES MIL-STD-40051 Personnel REV A 1.0 20241018//EN",
+    ),
+    "procedural_steps": (
+        "procedural_steps",
+        "../entities/procedural_steps",
+        "-//TRG//ENTITIES MIL-STD-40051 Procedural Steps REV A 1.0 20241018//EN",
+    ),
+    "references": (
+        "references",
+        "../entities/references",
+        "-//TRG//ENTITIES MIL-STD-40051 References REV A 1.0 20241018//EN",
+    ),
+    "special_tools": (
+        "special_tools",
+        "../entities/special_tools",
+        "-//TRG//ENTITIES MIL-STD-40051 Special Tools REV A 1.0 20241018//EN",
+    ),
+    "test_equipment": (
+        "test_equipment",
+        "../entities/test_equipment",
+        "-//TRG//ENTITIES MIL-STD-40051 Test Equipment REV A 1.0 20241018//EN",
+    ),
+    "tools": (
+        "tools",
+        "../entities/tools",
+        "-//TRG//ENTITIES MIL-STD-40051 Tools REV A 1.0 20241018//EN",
+    ),
+    "warnings": (
+        "warnings",
+        "../entities/warnings",
+        "-//TRG//ENTITIES MIL-STD-40051 Warnings REV A 1.0 20241018//EN",
+    ),
+    "warning_summary": (
+        "warning_summary",
+        "../entities/warning_summary",
+        "-//TRG//ENTITIES MIL-STD-40051 Warning Summary REV A 1.0 20241018//EN",
+    ),
+}
+# One bit per entity file, so a work package's declarations fit in a single int
+ENTITY_FILE_BITS = {key: 1 << position for position, key in enumerate(ENTITY_FILES)}
+# Entity files whose declarations need others declared before them, whatever they reference
+ENTITY_FILE_DEPENDENCIES = {"editboil": ("selectboil",)}
+# Entity index of a worker process, set once by set_worker_entity_index as the worker starts
+worker_entity_index = {}
+
+
+def scan_entity_files(
+    entity_files: list[Path],
+    cache: Optional["ScanCache"] = None,
+    profiler: Optional[Profiler] = None,
+) -> dict:
+    """"""
+    ext_entity_dict = {}
+
+    with cache_committed(cache):
+        for path in entity_files:
+            # Reuse the entity names from the last run if the file hasn't changed
+            entity_names = cache.get_entity_file(path) if cache else None
+            if entity_names is None:
+                # Open and read the entity file
+                parse = timed(read_entity_file, profiler)(path)
+                entity_names = record_timed(
+                    profiler, "entity_files", path, parse, lambda _: path.stat().st_size
+                )
+                if cache:
+                    cache.put_entity_file(path, entity_names)
+            ext_entity_dict[path.stem] = entity_names
+
+    return ext_entity_dict
+
+
+def read_entity_file(path: Path) -> dict:
+    """"""
+    with path.open("r", encoding="utf-8") as entity_file:
+        return parse_entity_declarations(entity_file)
+
+
+def parse_entity_declarations(entity_file: TextIO) -> dict:
+    """"""
+    # Declared names in file order, each with the entities its replacement text references
+    entity_names = {}
+    pending = ""
+    while True:
+        chunk = entity_file.read(ENTITY_READ_SIZE)
+        text = pending + chunk
+
+        # Replacement text may hold markup, so only a declaration that another one follows is
+        # known to be complete; the last one (or a cut-off "<!ENTITY") waits for the next chunk
+        end = len(text)
+        if chunk:
+            start = text.rfind("<!ENTITY")
+            end = min(start if start != -1 else end, end - len("<!ENTITY") + 1)
+            end = max(end, 0)
+        for match in ENTITY_DECLARATION_PATTERN.finditer(text, 0, end):
+            replacement_text = match[2] if match[2] is not None else match[3]
+            references = (
+                list(dict.fromkeys(ENTITY_REFERENCE_PATTERN.findall(replacement_text)))
+                if replacement_text
+                else []
+            )
+            # The first declaration of a name is the binding one
+            entity_names.setdefault(match[1], references)
+        pending = text[end:]
+
+        if not chunk:
+            return entity_names
+
+
+def scan_work_packages(
+    xml_files: list[Path],
+    cache: Optional["ScanCache"] = None,
+    jobs: int = SCAN_JOBS,
+    processes: bool = False,
+    cancel: Optional[threading.Event] = None,
+    profiler: Optional[Profiler] = None,
+    read_ahead: int = 0,
+    reader: Optional[Callable] = None,
+    chunk_size: int = SCAN_CHUNK_SIZE,
+) -> Iterator["WorkPackage"]:
+    """"""
+    if read_ahead > 0 and processes:
+        raise ValueError("read-ahead analyzes in this process and can't use worker processes")
+    # Without read-ahead, a custom reader still does the reading, in the workers
+    analyze = functools.partial(read_and_analyze, reader) if reader else analyze_work_package
+
+    with cache_committed(cache):
+        # A window at a time, so neither the cache hits nor the analyses pile up in memory
+        for start in range(0, len(xml_files), SCAN_WINDOW_SIZE):
+            window = xml_files[start : start + SCAN_WINDOW_SIZE]
+
+            # Only read and analyze work packages that changed since the last run
+            cached = {path: cache.get_work_package(path) if cache else None for path in window}
+            uncached = [path for path, hit in cached.items() if hit is None]
+            if read_ahead > 0:
+                # On a slow share the reads are the bottleneck: keep a pool of them ahead of the
+                # analysis, which then runs here on one finished buffer after the other
+                analyzed = map_read_ahead(
+                    timed(unless_cancelled(analyze_buffer, cancel), profiler),
+                    uncached,
+                    read_ahead,
+                    reader or read_work_package,
+                )
+            else:
+                analyzed = parallel_map(
+                    timed(unless_cancelled(analyze, cancel, processes), profiler),
+                    uncached,
+                    jobs,
+                    chunk_size,
+                    processes,
+                )
+
+            with contextlib.closing(analyzed):
+                for path in window:
+                    # Merge the analyzed files back in path order so the output is deterministic
+                    work_package = cached.pop(path)
+                    is_hit = work_package is not None
+                    if not is_hit:
+                        work_package = record_timed(
+                            profiler, "scan", path, next(analyzed), lambda result: result.size
+                        )
+                        record_scan_parts(profiler, work_package)
+                    if is_cancelled(cancel) or work_package is None:
+                        return
+                    if cache and not is_hit:
+                        cache.put_work_package(work_package)
+                    yield work_package
+
+
+@dataclass
+class ProjectInventory:
+    """"""
+
+    entity_files: list[Path] = field(default_factory=list)
+    work_packages: list[Path] = field(default_factory=list)
+    # SVG graphics by board number
+    graphics: dict[str, Path] = field(default_factory=dict)
+
+
+def walk_project(folder_path: Path) -> ProjectInventory:
+    """"""
+    inventory = ProjectInventory()
+    # Directories still to visit, with whether they are inside the SVG graphics folder
+    pending = [(os.fspath(folder_path), False)]
+
+    while pending:
+        directory, in_graphics = pending.pop()
+        is_files_dir = os.path.basename(directory) == "files"
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            # Folders we may not list, e.g. $RECYCLE.BIN on a share, hold nothing we need
+            continue
+        with entries:
+            for entry in entries:
+                name = entry.name
+                lower_name = name.lower()
+                if entry.is_dir(follow_symlinks=False):
+                    if not is_pruned_directory(lower_name):
+                        pending.append((entry.path, in_graphics or lower_name == GRAPHICS_DIR))
+                elif lower_name.endswith(".ent"):
+                    # Only boilerplate and project entity files feed the index
+                    lower_path = entry.path.lower()
+                    if "boilerplate" in lower_path or "entities" in lower_path:
+                        inventory.entity_files.append(Path(entry.path))
+                elif is_files_dir and name.endswith(".xml"):
+                    path = Path(entry.path)
+                    if is_work_package_file(path):
+                        inventory.work_packages.append(path)
+                elif in_graphics and lower_name.endswith(".svg"):
+                    inventory.graphics[name[:-4]] = Path(entry.path)
+
+    # Directory order depends on the file system; keep every phase deterministic
+    inventory.entity_files.sort()
+    inventory.work_packages.sort()
+    return inventory
+
+
+def is_work_package(path: Path, folder_path: Path) -> bool:
+    """"""
+    # The rules walk_project applies on its way down, checked for a single path
+    if not path.is_relative_to(folder_path):
+        return False
+    folders = path.relative_to(folder_path).parts[:-1]
+    return is_work_package_file(path) and not any(
+        is_pruned_directory(folder.lower()) for folder in folders
+    )
+
+
+def is_work_package_file(path: Path) -> bool:
+    """"""
+    return path.parent.name == "files" and path.name.endswith(".xml") and not should_skip_file(path)
+
+
+def is_pruned_directory(lower_name: str) -> bool:
+    """"""
+    # Submission copies, hidden folders, output and non-SVG graphics never hold anything we read
+    return (
+        lower_name.startswith(("!", "."))
+        or lower_name in PRUNED_DIRS
+        or (lower_name.startswith("graphics") and lower_name != GRAPHICS_DIR)
+    )
+
+
+def parallel_map(
+    function: Callable,
+    items: list,
+    jobs: int = SCAN_JOBS,
+    chunk_size: int = SCAN_CHUNK_SIZE,
+    processes: bool = False,
+    initializer: Optional[Callable] = None,
+    initargs: tuple = (),
+) -> Iterator:
+    """"""
+    # Small batches aren't worth the worker start-up cost; this process then plays the worker
+    if jobs <= 1 or len(items) <= chunk_size:
+        if initializer:
+            initializer(*initargs)
+        yield from map(function, items)
+        return
+
+    # Hand out work in chunks and yield the results in the order the items were given
+    chunks = [items[start : start + chunk_size] for start in range(0, len(items), chunk_size)]
+    executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    executor = executor_class(max_workers=jobs, initializer=initializer, initargs=initargs)
+    try:
+        for results in executor.map(functools.partial(map_chunk, function), chunks):
+            yield from results
+    finally:
+        # Drop the chunks nobody started yet if the caller stops early
+        executor.shutdown(cancel_futures=True)
+
+
+def map_read_ahead(function: Callable, paths: list[Path], reads: int, reader: Callable) -> Iterator:
+    """"""
+    with contextlib.closing(prefetch_files(paths, reads, reader)) as buffers:
+        yield from map(function, buffers)
+
+
+def prefetch_files(
+    paths: list[Path],
+    reads: int,
+    reader: Callable,
+    max_bytes: int = READ_AHEAD_BYTES,
+) -> Iterator[tuple[Path, tuple]]:
+    """"""
+    # Start a read whenever fewer than `reads` are pending, unless the finished ones waiting for
+    # the caller already hold max_bytes; the results come back in path order all the same, each
+    # with the seconds its read took
+    pending = collections.deque()
+    remaining = iter(paths)
+    executor = ThreadPoolExecutor(max_workers=reads)
+    try:
+        while True:
+            while len(pending) < reads and get_buffered_bytes(pending) < max_bytes:
+                path = next(remaining, None)
+                if path is None:
+                    break
+                pending.append((path, executor.submit(call_timed, reader, path)))
+            if not pending:
+                return
+            path, future = pending.popleft()
+            yield path, future.result()
+    finally:
+        # Drop the reads nobody started yet if the caller stops early
+        executor.shutdown(cancel_futures=True)
+
+
+def get_buffered_bytes(pending: collections.deque) -> int:
+    """"""
+    # Reads still in flight count as nothing, so at most `reads` files go over the limit
+    return sum(
+        len(future.result()[1][1])
+        for _, future in pending
+        if future.done() and future.exception() is None
+    )
+
+
+def map_chunk(function: Callable, chunk: list) -> list:
+    """"""
+    return [function(item) for item in chunk]
+
+
+def unless_cancelled(
+    function: Callable, cancel: Optional[threading.Event], processes: bool = False
+) -> Callable:
+    """"""
+    # Events can't be shared with worker processes, so those are only stopped between chunks
+    if cancel is None or processes:
+        return function
+    return functools.partial(call_unless_cancelled, function, cancel)
+
+
+def call_unless_cancelled(function: Callable, cancel: threading.Event, item):
+    """"""
+    return None if cancel.is_set() else function(item)
+
+
+def is_cancelled(cancel: Optional[threading.Event]) -> bool:
+    """"""
+    return cancel is not None and cancel.is_set()
+
+
+def should_skip_file(path: Path) -> bool:
+    """"""
+    return any(term in path.name.lower() for term in files_to_skip)
+
+
+@dataclass
+class WorkPackage:
+    """"""
+
+    path: Path
+    opening_tag: Optional[str] = None
+    graphics: list[str] = field(default_factory=list)
+    entities: list[str] = field(default_factory=list)
+    # Byte offset of the first byte after the existing XML declaration and DOCTYPE
+    prolog_end: int = 0
+    newline: str = "\n"
+    # File state at analysis time, used to detect edits made after the scan
+    mtime_ns: int = 0
+    size: int = 0
+    # Digest of the existing prolog bytes, used to skip files that are already up to date
+    prolog_digest: str = ""
+    # Time spent reading and analyzing the file, and the part of it spent reading; zero when it
+    # came from the scan cache
+    scan_seconds: float = 0.0
+    read_seconds: float = 0.0
+    # Time spent writing the updated file
+    write_seconds: float = 0.0
+
+
+def read_work_package(path: Path) -> tuple[os.stat_result, bytes]:
+    """"""
+    # The stat comes from the open file, so it matches the bytes that were read
+    with path.open("rb") as fin:
+        return os.fstat(fin.fileno()), fin.read()
+
+
+def read_and_analyze(reader: Callable, path: Path) -> WorkPackage:
+    """"""
+    return analyze_buffer((path, call_timed(reader, path)))
+
+
+def analyze_buffer(item: tuple[Path, tuple[float, tuple[os.stat_result, bytes]]]) -> WorkPackage:
+    """"""
+    # The read happened ahead, in another thread; count it as part of the scan all the same
+    path, (read_seconds, (stat, data)) = item
+    work_package = analyze_work_package(path, data, stat)
+    work_package.read_seconds = read_seconds
+    work_package.scan_seconds += read_seconds
+    return work_package
+
+
+def analyze_work_package(
+    path: Path, data: Optional[bytes] = None, stat: Optional[os.stat_result] = None
+) -> WorkPackage:
+    """"""
+    start = time.perf_counter()
+    # Read the work package once; everything below works from this buffer
+    with contextlib.ExitStack() as stack:
+        if data is None:
+            fin = stack.enter_context(path.open("rb"))
+            stat = os.fstat(fin.fileno())
+            # Start with just the top of the file, which is all empty and chapter files need
+            header = read_header(fin)
+            read_seconds = time.perf_counter() - start
+        else:
+            read_seconds = 0.0
+            stat = path.stat() if stat is None else stat
+            header = data
+
+        work_package = WorkPackage(
+            path, get_opening_tag(header), mtime_ns=stat.st_mtime_ns, size=stat.st_size
+        )
+
+        # Empty and chapter-level files are never previewed or rewritten
+        if work_package.opening_tag is None:
+            work_package.scan_seconds = time.perf_counter() - start
+            work_package.read_seconds = read_seconds
+            return work_package
+
+        if data is None:
+            read_start = time.perf_counter()
+            data = header + fin.read()
+            read_seconds += time.perf_counter() - read_start
+        work_package.read_seconds = read_seconds
+
+    work_package.graphics, work_package.entities = scan_text_for_entities(data.decode("utf-8"))
+    work_package.prolog_end = find_prolog_end(header)
+    work_package.prolog_digest = get_prolog_digest(header[: work_package.prolog_end])
+
+    # Keep the line ending style of the original file when writing the new prolog
+    first_newline = data.find(b"\n")
+    if first_newline > 0 and data[first_newline - 1 : first_newline] == b"\r":
+        work_package.newline = "\r\n"
+
+    work_package.scan_seconds = time.perf_counter() - start
+    return work_package
+
+
+def scan_text_for_entities(text: str) -> tuple[list[str], list[str]]:
+    """"""
+    new_graphics = {}
+    new_entities = {}
+
+    # One pass over the whole buffer finds graphic board numbers and entity references alike
+    # Names are interned so that work packages referencing the same ones share the strings
+    for boardno, entity in ENTITY_SCAN_PATTERN.findall(text):
+        if boardno:
+            new_graphics[sys.intern(boardno)] = None
+        else:
+            new_entities[sys.intern(entity)] = None
+
+    return list(new_graphics), list(new_entities)
+
+
+def get_entity_lines(work_package: WorkPackage, entity_index: dict) -> list[str]:
+    """"""
+    # Declarations sort before graphics ("%" < any boardno character), so neither needs a merge
+    new_external_entities = render_entity_mask(get_entity_mask(work_package, entity_index))
+    new_graphics = [
+        f'\t<!ENTITY {boardno} SYSTEM "../graphics-SVG/{boardno}.svg" NDATA svg>'
+        for boardno in sorted(set(work_package.graphics))
+    ]
+    return new_external_entities + new_graphics
+
+
+def get_entity_mask(work_package: WorkPackage, entity_index: dict) -> int:
+    """"""
+    # One bit per ENTITY_FILES entry, each name already carrying the files it depends on;
+    # duplicates and unknown names cost nothing
+    entity_mask = 0
+    for entity_name in work_package.entities:
+        entity_mask |= entity_index.get(entity_name, 0)
+    return entity_mask
+
+
+def render_entity_mask(entity_mask: int) -> list[str]:
+    """"""
+    return [
+        render_entity_declaration(key) for bit, key in get_declaration_order() if entity_mask & bit
+    ]
+
+
+def get_missing_graphics(work_package: WorkPackage, graphics: dict) -> list[str]:
+    """"""
+    # The inventory already lists every SVG, so each check is a lookup instead of a stat
+    return [boardno for boardno in work_package.graphics if boardno not in graphics]
+
+
+def get_unreferenced_graphics(work_packages: list[WorkPackage], graphics: dict) -> list[str]:
+    """"""
+    referenced = set(itertools.chain.from_iterable(wp.graphics for wp in work_packages))
+    return sorted(boardno for boardno in graphics if boardno not in referenced)
+
+
+def build_entity_index(ext_entity_dict: dict) -> dict:
+    """"""
+    # Walk the entity files in priority order so the first file declaring a name wins
+    owners = {}
+    for key in ENTITY_FILES:
+        for entity_name in ext_entity_dict.get(key, ()):
+            owners.setdefault(entity_name, key)
+
+    # Each name maps to the bits of its own file and of every file its expansion needs
+    entity_index = {}
+    for entity_name in owners:
+        if entity_name not in entity_index:
+            resolve_entity_mask(entity_name, owners, ext_entity_dict, entity_index)
+
+    return entity_index
+
+
+def resolve_entity_mask(
+    entity_name: str, owners: dict, ext_entity_dict: dict, entity_index: dict
+) -> None:
+    """"""
+    # Depth-first over the references, resolving each name after everything it references;
+    # a stack instead of recursion, as boilerplate can nest deeply
+    stack = [(entity_name, False)]
+    in_progress = set()
+    while stack:
+        name, expanded = stack.pop()
+        if name in entity_index:
+            continue
+        key = owners[name]
+        references = ext_entity_dict[key][name]
+        if not expanded:
+            in_progress.add(name)
+            stack.append((name, True))
+            # A reference back into the names being resolved is a cycle, which XML forbids
+            stack.extend(
+                (reference, False)
+                for reference in references
+                if reference in owners and reference not in in_progress
+            )
+            continue
+
+        in_progress.discard(name)
+        entity_mask = get_required_bits(key)
+        for reference in references:
+            entity_mask |= entity_index.get(reference, 0)
+        entity_index[name] = entity_mask
+
+
+@functools.lru_cache(maxsize=None)
+def get_required_bits(key: str) -> int:
+    """"""
+    # An entity file's bit plus those of the files it depends on, transitively
+    required_bits = ENTITY_FILE_BITS[key]
+    for dependency in ENTITY_FILE_DEPENDENCIES.get(key, ()):
+        required_bits |= get_required_bits(dependency)
+    return required_bits
+
+
+@functools.lru_cache(maxsize=None)
+def get_declaration_order() -> tuple[tuple[int, str], ...]:
+    """"""
+    # Entity file bits in the order their declarations sort in the DOCTYPE, except that each
+    # file comes right after the files it depends on
+    order = {}
+
+    def visit(key: str) -> None:
+        if key not in order:
+            for dependency in ENTITY_FILE_DEPENDENCIES.get(key, ()):
+                visit(dependency)
+            order[key] = None
+
+    for key in sorted(ENTITY_FILES, key=render_entity_declaration):
+        visit(key)
+    return tuple((ENTITY_FILE_BITS[key], key) for key in order)
+
+
+@functools.lru_cache(maxsize=None)
+def render_entity_declaration(key: str) -> str:
+    """"""
+    entity_name, filename, public_id = ENTITY_FILES[key]
+    return f'\t<!ENTITY % {entity_name} PUBLIC "{public_id}" "{filename}.ent"> %{entity_name};'
+
+
+class ScanCache:
+    """"""
+
+    def __init__(self, cache_path: Path, folder_path: Optional[Path] = None) -> None:
+        """"""
+        # Rows are keyed relative to the project, so every spelling of its root shares them;
+        # the daemon works with resolved paths, the CLI and GUI with the root as given
+        self.folder_paths = (folder_path, folder_path.resolve()) if folder_path is not None else ()
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(cache_path)
+        # Entries written since the last commit
+        self.pending = 0
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS entity_files (
+                path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, entities TEXT
+            );
+            CREATE TABLE IF NOT EXISTS work_packages (
+                path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, analysis TEXT
+            );
+            """)
+
+        # Throw away entries written by an older analyzer
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != str(CACHE_VERSION):
+            self.connection.execute("DELETE FROM entity_files")
+            self.connection.execute("DELETE FROM work_packages")
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(CACHE_VERSION),)
+            )
+            self.connection.commit()
+
+    def __enter__(self) -> "ScanCache":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """"""
+        self.commit()
+        self.connection.close()
+
+    def commit(self) -> None:
+        """"""
+        # An open write transaction locks the cache for every other process, so keep them short
+        if not self.connection.in_transaction:
+            return
+        try:
+            self.connection.commit()
+        except sqlite3.Error:
+            # Still locked by someone else: drop these entries rather than keep the lock waiting
+            with contextlib.suppress(sqlite3.Error):
+                self.connection.rollback()
+        self.pending = 0
+
+    def _lookup(self, table: str, column: str, path: Path) -> Optional[str]:
+        """"""
+        try:
+            stat = path.stat()
+            row = self.connection.execute(
+                f"SELECT mtime_ns, size, {column} FROM {table} WHERE path = ?",
+                (self._key(path),),
+            ).fetchone()
+        except (OSError, sqlite3.Error):
+            # A vanished file or a busy cache is just a miss
+            return None
+        # Only trust the entry if the file is still the one that was analyzed
+        if row and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+            return row[2]
+        return None
+
+    def get_entity_file(self, path: Path) -> Optional[dict]:
+        """"""
+        entities = self._lookup("entity_files", "entities", path)
+        return json.loads(entities) if entities is not None else None
+
+    def put_entity_file(self, path: Path, entity_names: dict) -> None:
+        """"""
+        stat = path.stat()
+        self._put(
+            "INSERT OR REPLACE INTO entity_files VALUES (?, ?, ?, ?)",
+            (self._key(path), stat.st_mtime_ns, stat.st_size, json.dumps(entity_names)),
+        )
+
+    def get_work_package(self, path: Path) -> Optional[WorkPackage]:
+        """"""
+        analysis = self._lookup("work_packages", "analysis", path)
+        if analysis is None:
+            return None
+        analysis = json.loads(analysis)
+        for names in ("graphics", "entities"):
+            analysis[names] = [sys.intern(name) for name in analysis[names]]
+        return WorkPackage(path, **analysis)
+
+    def put_work_package(self, work_package: WorkPackage) -> None:
+        """"""
+        analysis = asdict(work_package)
+        for name in ("path", "scan_seconds", "read_seconds", "write_seconds"):
+            del analysis[name]
+        self._put(
+            "INSERT OR REPLACE INTO work_packages VALUES (?, ?, ?, ?)",
+            (
+                self._key(work_package.path),
+                work_package.mtime_ns,
+                work_package.size,
+                json.dumps(analysis),
+            ),
+        )
+
+    def _key(self, path: Path) -> str:
+        """"""
+        for folder_path in self.folder_paths:
+            if path.is_relative_to(folder_path):
+                return path.relative_to(folder_path).as_posix()
+        return str(path)
+
+    def _put(self, statement: str, parameters: tuple) -> None:
+        """"""
+        # A cache another process keeps busy only costs speed, like a missing one
+        try:
+            self.connection.execute(statement, parameters)
+        except sqlite3.Error:
+            return
+        self.pending += 1
+        if self.pending >= CACHE_COMMIT_SIZE:
+            self.commit()
+
+
+@contextlib.contextmanager
+def cache_committed(cache: Optional[ScanCache]):
+    """"""
+    try:
+        yield cache
+    finally:
+        if cache:
+            cache.commit()
+
+
+def get_cache_path(folder_path: Path) -> Path:
+    """"""
+    cache_root = os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME")
+    cache_dir = Path(cache_root) if cache_root else Path.home() / ".cache"
+
+    # One cache file per project, named after the project's absolute path
+    project_key = hashlib.sha1(str(Path(folder_path).resolve()).encode("utf-8")).hexdigest()
+    return cache_dir / "iads-entity-scanner" / f"{project_key[:16]}.sqlite"
+
+
+@contextlib.contextmanager
+def open_scan_cache(folder_path: Path):
+    """"""
+    # A missing or unwritable cache only costs speed, so fall back to a full scan
+    try:
+        cache = ScanCache(get_cache_path(folder_path), Path(folder_path))
+    except (OSError, sqlite3.Error):
+        yield None
+        return
+
+    with cache:
+        yield cache
+
+
+class UsageIndex:
+    """"""
+
+    def __init__(self) -> None:
+        """"""
+        # Names each work package uses, and the work packages using each name
+        self.work_packages = {}
+        self.entity_users = {}
+        self.graphic_users = {}
+
+    def add(self, work_package: WorkPackage) -> None:
+        """"""
+        self.remove(work_package.path)
+        entities, graphics = list(work_package.entities), list(work_package.graphics)
+        self.work_packages[work_package.path] = (entities, graphics)
+        for name in entities:
+            self.entity_users.setdefault(name, set()).add(work_package.path)
+        for boardno in graphics:
+            self.graphic_users.setdefault(boardno, set()).add(work_package.path)
+
+    def remove(self, path: Path) -> None:
+        """"""
+        entities, graphics = self.work_packages.pop(path, ((), ()))
+        for users, names in ((self.entity_users, entities), (self.graphic_users, graphics)):
+            for name in names:
+                users[name].discard(path)
+                if not users[name]:
+                    del users[name]
+
+    def who_uses(self, name: str) -> list[Path]:
+        """"""
+        return sorted(self.entity_users.get(name, set()) | self.graphic_users.get(name, set()))
+
+    def uses(self, path: Path) -> tuple[list[str], list[str]]:
+        """"""
+        return self.work_packages.get(path, ([], []))
+
+    def find(self, pattern: str) -> dict[str, list[Path]]:
+        """"""
+        # Shell-style wildcards, matched without regard to case
+        matches = re.compile(fnmatch.translate(pattern), re.IGNORECASE).match
+        names = itertools.chain(self.entity_users, self.graphic_users)
+        return {name: self.who_uses(name) for name in sorted(set(names)) if matches(name)}
+
+    def save(self, path: Path, folder_path: Optional[Path] = None) -> None:
+        """"""
+        # Project-relative paths, so the index loads whichever way the project root is spelled
+        usage = {
+            (
+                wp_path.relative_to(folder_path).as_posix()
+                if folder_path and wp_path.is_relative_to(folder_path)
+                else str(wp_path)
+            ): {"entities": entities, "graphics": graphics}
+            for wp_path, (entities, graphics) in self.work_packages.items()
+        }
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps({"work_packages": usage}), encoding="utf-8")
+
+    @classmethod
+    def load(cls, path: Path, folder_path: Optional[Path] = None) -> "UsageIndex":
+        """"""
+        usage_index = cls()
+        usage = json.loads(path.read_text(encoding="utf-8"))["work_packages"]
+        for wp_path, names in usage.items():
+            # Absolute paths, from an index saved without its project, stay as they are
+            wp_path = Path(folder_path, wp_path) if folder_path else Path(wp_path)
+            usage_index.add(WorkPackage(wp_path, **names))
+        return usage_index
+
+
+def get_usage_index_path(folder_path: Path) -> Path:
+    """"""
+    return get_cache_path(folder_path).with_suffix(".usage.json")
+
+
+@dataclass
+class WatchChanges:
+    """"""
+
+    # Work packages analyzed again, or whose entity declarations or graphics changed
+    work_packages: list[WorkPackage] = field(default_factory=list)
+    removed: list[Path] = field(default_factory=list)
+    # Entity files parsed again, added or removed
+    entity_files: list[Path] = field(default_factory=list)
+
+
+class ProjectWatcher:
+    """"""
+
+    def __init__(
+        self,
+        folder_path: Path,
+        cache: Optional[ScanCache] = None,
+        jobs: int = SCAN_JOBS,
+        read_ahead: int = 0,
+    ) -> None:
+        """"""
+        self.folder_path = folder_path
+        self.cache = cache
+        self.jobs = jobs
+        self.read_ahead = read_ahead
+        # Stat and declared names of every entity file seen by the last poll
+        self.entity_files = {}
+        self.ext_entity_dict = {}
+        self.entity_index = {}
+        self.graphics = {}
+        self.work_packages = {}
+        self.usage_index = UsageIndex()
+
+    def poll(self) -> WatchChanges:
+        """"""
+        # The first poll reads the whole project; later ones only what changed since
+        inventory = walk_project(self.folder_path)
+        changes = WatchChanges()
+
+        changed_names = self._refresh_entity_files(inventory.entity_files, changes)
+        changed_paths = set()
+        for name in self._refresh_entity_index(changed_names):
+            changed_paths.update(self.usage_index.entity_users.get(name, ()))
+
+        # An SVG that appeared or disappeared changes the missing graphics of its users
+        for boardno in self.graphics.keys() ^ inventory.graphics.keys():
+            changed_paths.update(self.usage_index.graphic_users.get(boardno, ()))
+        self.graphics = inventory.graphics
+
+        current = set(inventory.work_packages)
+        for path in [path for path in self.work_packages if path not in current]:
+            del self.work_packages[path]
+            self.usage_index.remove(path)
+            changes.removed.append(path)
+
+        modified = [
+            path
+            for path in inventory.work_packages
+            if path not in self.work_packages or self._is_modified(self.work_packages[path])
+        ]
+        for work_package in scan_work_packages(
+            modified, self.cache, self.jobs, read_ahead=self.read_ahead
+        ):
+            self.remember(work_package)
+            changed_paths.add(work_package.path)
+
+        changes.work_packages = [
+            self.work_packages[path]
+            for path in sorted(changed_paths)
+            if path in self.work_packages and self.work_packages[path].opening_tag is not None
+        ]
+        return changes
+
+    def refresh(self, path: Path) -> Optional[WorkPackage]:
+        """"""
+        # Cheaper than poll() for a single file: stat the known entity files and this one only
+        changes = WatchChanges()
+        self._refresh_entity_index(self._refresh_entity_files(list(self.entity_files), changes))
+
+        # Only what a poll would pick up; anything else isn't the watcher's to analyze
+        if not is_work_package(path, self.folder_path):
+            return None
+        work_package = self.work_packages.get(path)
+        if not path.is_file():
+            if work_package is not None:
+                del self.work_packages[path]
+                self.usage_index.remove(path)
+            return None
+        if work_package is None or self._is_modified(work_package):
+            work_package = analyze_work_package(path)
+            self.remember(work_package)
+        return work_package
+
+    def remember(self, work_package: WorkPackage) -> None:
+        """"""
+        # Also called with rewritten files so the next poll doesn't report them again
+        self.work_packages[work_package.path] = work_package
+        if work_package.opening_tag is None:
+            self.usage_index.remove(work_package.path)
+        else:
+            self.usage_index.add(work_package)
+
+    def _is_modified(self, work_package: WorkPackage) -> bool:
+        """"""
+        try:
+            return is_modified(work_package)
+        except OSError:
+            # Removed since the walk; the next poll drops it
+            return False
+
+    def _refresh_entity_files(self, entity_files: list[Path], changes: WatchChanges) -> set:
+        """"""
+        changed_names = set()
+        current = set(entity_files)
+        for path in [path for path in self.entity_files if path not in current]:
+            changed_names.update(self.entity_files.pop(path)[2])
+            changes.entity_files.append(path)
+
+        for path in entity_files:
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            known = self.entity_files.get(path)
+            if known and known[:2] == (stat.st_mtime_ns, stat.st_size):
+                continue
+            # Only the edited file is parsed again
+            entity_names = scan_entity_files([path], self.cache)[path.stem]
+            # Names added, removed or referencing something else
+            known_names = known[2] if known else {}
+            changed_names.update(
+                name
+                for name in entity_names.keys() | known_names.keys()
+                if entity_names.get(name) != known_names.get(name)
+            )
+            self.entity_files[path] = (stat.st_mtime_ns, stat.st_size, entity_names)
+            changes.entity_files.append(path)
+
+        if changes.entity_files:
+            # Same order as scan_entity_files, so duplicate file names resolve the same way
+            self.ext_entity_dict = {
+                path.stem: entity_names
+                for path, (_, _, entity_names) in sorted(self.entity_files.items())
+            }
+        return changed_names
+
+    def _refresh_entity_index(self, changed_names: set) -> list[str]:
+        """"""
+        # A change can reach any name whose expansion references it, so rebuild the index
+        # (the entity files themselves are already parsed) and keep the names that moved
+        if not changed_names:
+            return []
+        entity_index = build_entity_index(self.ext_entity_dict)
+        moved = [
+            name
+            for name in entity_index.keys() | self.entity_index.keys()
+            if entity_index.get(name) != self.entity_index.get(name)
+        ]
+        self.entity_index = entity_index
+        return moved
+
+
+def get_manifest_record(
+    work_package: WorkPackage, entity_index: dict, folder_path: Optional[Path] = None
+) -> dict:
+    """"""
+    unresolved = [
+        name
+        for name in work_package.entities
+        if name not in entity_index and name not in XML_ENTITIES
+    ]
+    path = work_package.path.relative_to(folder_path) if folder_path else work_package.path
+    return {
+        "path": path.as_posix(),
+        "root_tag": work_package.opening_tag,
+        "graphics": list(work_package.graphics),
+        # Exactly what the DOCTYPE internal subset will hold
+        "declarations": get_entity_lines(work_package, entity_index),
+        "unresolved": unresolved,
+        "scan_seconds": round(work_package.scan_seconds, 6),
+    }
+
+
+class ManifestWriter:
+    """"""
+
+    def __init__(self, stream: TextIO, manifest_format: str = "jsonl") -> None:
+        """"""
+        # Records go straight to the stream, so memory use doesn't grow with the project
+        self.stream = stream
+        self.csv_writer = None
+        if manifest_format == "csv":
+            self.csv_writer = csv.DictWriter(stream, MANIFEST_FIELDS)
+            self.csv_writer.writeheader()
+
+    def write(self, record: dict) -> None:
+        """"""
+        if self.csv_writer is None:
+            self.stream.write(json.dumps(record) + "\n")
+            return
+        # List columns hold one name or declaration per line of the cell
+        self.csv_writer.writerow(
+            {
+                key: "\n".join(value) if isinstance(value, list) else value
+                for key, value in record.items()
+            }
+        )
+
+
+def get_manifest_format(path: Path) -> str:
+    """"""
+    return "csv" if path.suffix.lower() == ".csv" else "jsonl"
+
+
+def get_opening_tag(header: bytes) -> Optional[str]:
+    """"""
+    opening_tag = None  # Initialize opening_tag to None
+
+    # Find the first line that opens an element (not the XML declaration, a DOCTYPE or a close)
+    match = ROOT_LINE_PATTERN.search(header)
+    line = match.group().decode("utf-8", errors="replace") if match else ""
+    if line:
+        opening_tag = next(iter(re.findall(r"([a-zA-Z._-]+)", line)), None)
+
+    # Check if the line contains any chapter-related tags
+    if (
+        opening_tag
+        and len(opening_tag) >= 2
+        and not any(chap_tag in line for chap_tag in CHAPTER_TAGS)
+    ):
+        return opening_tag
+    else:
+        # logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+        # logging.info("No valid opening tag found in %s.", path)
+        return None
+
+
+def read_header(fin: BinaryIO) -> bytes:
+    """"""
+    header = b""
+
+    # Grow the window until it holds the whole opening tag line, or the file ends
+    while True:
+        chunk = fin.read(max(HEADER_READ_SIZE, len(header)))
+        header += chunk
+        match = ROOT_LINE_PATTERN.search(header)
+        if not chunk or (match and match.end() < len(header)):
+            return header
+
+
+def get_prolog_digest(prolog: bytes) -> str:
+    """"""
+    return hashlib.sha1(prolog).hexdigest()
+
+
+def find_prolog_end(data: bytes) -> int:
+    """"""
+    position = len(UTF8_BOM) if data.startswith(UTF8_BOM) else 0
+    prolog_end = position
+    found_doctype = False
+
+    # Walk the declarations, comments and processing instructions ahead of the root element
+    while match := PROLOG_PATTERN.match(data, position):
+        position = match.end()
+        if match.group("doctype"):
+            prolog_end = position
+            found_doctype = True
+        elif match.group("xml") and not found_doctype:
+            prolog_end = position
+
+    # Drop the rest of the line the old prolog ended on, like the old "]>" line skip did
+    line_end = re.match(rb"[ \t]*\r?\n", data[prolog_end : prolog_end + 256])
+    if line_end:
+        prolog_end += line_end.end()
+
+    return prolog_end
+
+
+def record_scan_parts(profiler: Optional[Profiler], work_package: Optional[WorkPackage]) -> None:
+    """"""
+    # Tell the reads apart from the matching, to see whether a slow scan waits on I/O or parsing
+    if profiler is None or work_package is None:
+        return
+    path, size = work_package.path, work_package.size
+    read_seconds = work_package.read_seconds
+    profiler.add_file("read", path, read_seconds, size, ranked=False)
+    profiler.add_file("analyze", path, work_package.scan_seconds - read_seconds, size, ranked=False)
+
+
+def record_update_parts(
+    profiler: Optional[Profiler],
+    planned: WorkPackage,
+    seconds: float,
+    work_package: WorkPackage,
+    written: bool,
+) -> None:
+    """"""
+    # Rendering and comparing the prolog on one side, writing the file on the other
+    if profiler is None:
+        return
+    path, size = planned.path, planned.size
+    write_seconds = work_package.write_seconds if written else 0.0
+    profiler.add_file("render", path, seconds - write_seconds, size, ranked=False)
+    if written:
+        profiler.add_file("write", path, write_seconds, size, ranked=False)
+
+
+def update_work_packages(
+    work_packages: list[WorkPackage],
+    entity_index: dict,
+    cache: Optional[ScanCache] = None,
+    jobs: int = SCAN_JOBS,
+    processes: bool = False,
+    dry_run: bool = False,
+    cancel: Optional[threading.Event] = None,
+    profiler: Optional[Profiler] = None,
+    chunk_size: int = SCAN_CHUNK_SIZE,
+) -> Iterator[tuple[str, Optional[WorkPackage]]]:
+    """"""
+    # Worker processes receive the entity index once as they start, not pickled with every chunk
+    if processes:
+        function = functools.partial(process_file_in_worker, dry_run=dry_run)
+        initializer, initargs = set_worker_entity_index, (entity_index,)
+    else:
+        function = functools.partial(process_file, entity_index=entity_index, dry_run=dry_run)
+        initializer, initargs = None, ()
+    updated = parallel_map(
+        timed(unless_cancelled(function, cancel, processes), profiler),
+        work_packages,
+        jobs,
+        chunk_size,
+        processes,
+        initializer,
+        initargs,
+    )
+
+    with contextlib.closing(updated), cache_committed(cache):
+        for planned, result in zip(work_packages, updated):
+            size = planned.size
+            seconds = result[0] if profiler else 0.0
+            result = record_timed(profiler, "update", planned.path, result, lambda _: size)
+            # Files skipped after a cancel come back empty; those already written still count
+            if result is None:
+                continue
+            status, work_package = result
+            if work_package is not None:
+                written = status == WRITTEN and not dry_run
+                record_update_parts(profiler, planned, seconds, work_package, written)
+            # Remember the rewritten file so the next scan doesn't have to read it again
+            if status == WRITTEN and cache and not dry_run:
+                cache.put_work_package(work_package)
+            yield status, work_package
+
+            # Worker processes never see the cancel event, so stop handing them work here
+            if processes and is_cancelled(cancel):
+                return
+
+
+def set_worker_entity_index(entity_index: dict) -> None:
+    """"""
+    global worker_entity_index  # pylint: disable=W0603
+    worker_entity_index = entity_index
+
+
+def process_file_in_worker(
+    work_package: WorkPackage, dry_run: bool = False
+) -> tuple[str, Optional[WorkPackage]]:
+    """"""
+    return process_file(work_package, worker_entity_index, dry_run)
+
+
+def process_file(
+    work_package: WorkPackage, entity_index: dict, dry_run: bool = False
+) -> tuple[str, Optional[WorkPackage]]:
+    """"""
+    path = work_package.path
+    # logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    # logging.info("Opening %s.", path)
+
+    # Skip work packages that were removed since the scan
+    if not path.exists():
+        return SKIPPED, None
+
+    # Only analyze the file again if it was edited between the preview and the update
+    if is_modified(work_package):
+        work_package = analyze_work_package(path)
+
+    # If the file is empty or a chapter file, leave it untouched
+    if work_package.opening_tag is None:
+        return SKIPPED, None
+
+    # Don't touch files whose prolog already matches the one we would write
+    prolog = render_prolog(work_package, entity_index).encode("utf-8")
+    if get_prolog_digest(prolog) == work_package.prolog_digest:
+        return UNCHANGED, work_package
+
+    # Write the updated content to the file
+    if dry_run:
+        return WRITTEN, work_package
+    return WRITTEN, write_updated_file(work_package, prolog)
+
+
+def is_modified(work_package: WorkPackage) -> bool:
+    """"""
+    stat = work_package.path.stat()
+    return stat.st_mtime_ns != work_package.mtime_ns or stat.st_size != work_package.size
+
+
+def render_prolog(work_package: WorkPackage, entity_index: dict) -> str:
+    """"""
+    prolog_lines = [XML_TAG, *get_doctype_lines(work_package, entity_index)]
+    return "".join(f"{line}{work_package.newline}" for line in prolog_lines)
+
+
+def get_doctype_lines(work_package: WorkPackage, entity_index: dict) -> list[str]:
+    """"""
+    return [
+        f"<!DOCTYPE {work_package.opening_tag} {DOCTYPE_TAG_END}",
+        *get_entity_lines(work_package, entity_index),
+        DOCTYPE_END,
+    ]
+
+
+def write_updated_file(work_package: WorkPackage, prolog: bytes) -> WorkPackage:
+    """"""
+    path = work_package.path
+
+    start = time.perf_counter()
+    # Build the new file next to the original so it can be swapped in atomically
+    fd, temp_path = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb", buffering=0) as fout:
+            fout.write(prolog)
+            # Copy the remaining part of the file (excluding the old DOCTYPE) as raw bytes
+            with path.open("rb") as fin:
+                copy_file_body(fin, fout, work_package.prolog_end)
+        shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+    # The body is unchanged, so only the prolog offset and file state differ from the analysis
+    stat = path.stat()
+    return replace(
+        work_package,
+        prolog_end=len(prolog),
+        mtime_ns=stat.st_mtime_ns,
+        size=stat.st_size,
+        prolog_digest=get_prolog_digest(prolog),
+        write_seconds=time.perf_counter() - start,
+    )
+
+
+def copy_file_body(fin: BinaryIO, fout: BinaryIO, offset: int) -> None:
+    """"""
+    remaining = os.fstat(fin.fileno()).st_size - offset
+
+    # Let the kernel copy the body without passing it through Python where it can
+    if hasattr(os, "copy_file_range"):
+        with contextlib.suppress(OSError):
+            while remaining > 0:
+                copied = os.copy_file_range(fin.fileno(), fout.fileno(), remaining, offset)
+                if copied == 0:
+                    break
+                offset += copied
+                remaining -= copied
+
+    # Copy whatever is left in large blocks on platforms or file systems without it
+    fin.seek(offset)
+    shutil.copyfileobj(fin, fout, COPY_BUFFER_SIZE)
@@ -0,0 +1,200 @@
+"""IADS ENTITY SCANNER SERVER"""
+
+import json
+from collections import Counter
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+from scanner import (
+    SCAN_JOBS,
+    SKIPPED,
+    UNCHANGED,
+    WRITTEN,
+    ProjectWatcher,
+    ScanCache,
+    get_doctype_lines,
+    get_manifest_record,
+    is_work_package,
+    process_file,
+    render_prolog,
+    update_work_packages,
+)
+
+# Header every POST must carry; a web page can't add one cross-origin without a preflight
+REQUEST_HEADER = "X-IADS-Request"
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+
+
+class ScanServer(HTTPServer):
+    """"""
+
+    def __init__(
+        self,
+        folder_path: Path,
+        address: tuple[str, int] = (SERVER_HOST, SERVER_PORT),
+        cache: Optional[ScanCache] = None,
+        jobs: int = SCAN_JOBS,
+        read_ahead: int = 0,
+    ) -> None:
+        """"""
+        # A port already in use fails before the project is loaded, not after
+        super().__init__(address, ScanRequestHandler)
+        # The entity index and every work package analysis stay in memory between requests
+        self.folder_path = folder_path.resolve()
+        self.jobs = jobs
+        self.watcher = ProjectWatcher(self.folder_path, cache, jobs, read_ahead)
+        try:
+            self.watcher.poll()
+        except BaseException:
+            self.server_close()
+            raise
+
+    def get_work_packages(self, path: Optional[str]) -> list:
+        """"""
+        # A single file only stats the entity files and itself; the project needs a walk
+        if path is None:
+            self.watcher.poll()
+            work_packages = self.watcher.work_packages.values()
+        else:
+            work_package = self.watcher.refresh(self.resolve(path))
+            work_packages = [work_package] if work_package else []
+        return [wp for wp in work_packages if wp.opening_tag is not None]
+
+    def resolve(self, path: str) -> Path:
+        """"""
+        resolved = (self.folder_path / path).resolve()
+        if not resolved.is_relative_to(self.folder_path):
+            raise ValueError(f"{path} is outside of the project")
+        # Skipped, submission and other files a project scan leaves alone stay untouched here too
+        if not is_work_package(resolved, self.folder_path):
+            raise ValueError(f"{path} is not a work package of the project")
+        return resolved
+
+    def scan(self, path: Optional[str]) -> list:
+        """"""
+        entity_index = self.watcher.entity_index
+        return [
+            dict(
+                get_manifest_record(work_package, entity_index, self.folder_path),
+                doctype=get_doctype_lines(work_package, entity_index),
+            )
+            for work_package in self.get_work_packages(path)
+        ]
+
+    def render_prolog(self, path: str) -> Optional[str]:
+        """"""
+        work_packages = self.get_work_packages(path)
+        if not work_packages:
+            return None
+        return render_prolog(work_packages[0], self.watcher.entity_index)
+
+    def update(self, path: Optional[str], dry_run: bool = False) -> dict:
+        """"""
+        work_packages = self.get_work_packages(path)
+        if path is not None:
+            # One file isn't worth a worker pool
+            results = [
+                process_file(work_package, self.watcher.entity_index, dry_run)
+                for work_package in work_packages
+            ]
+        else:
+            results = update_work_packages(
+                work_packages,
+                self.watcher.entity_index,
+                self.watcher.cache,
+                self.jobs,
+                dry_run=dry_run,
+            )
+
+        status_counts = Counter()
+        written = []
+        for status, work_package in results:
+            status_counts[status] += 1
+            if work_package and status == WRITTEN:
+                written.append(work_package.path.relative_to(self.folder_path).as_posix())
+                if not dry_run:
+                    self.watcher.remember(work_package)
+        return {
+            WRITTEN: status_counts[WRITTEN],
+            UNCHANGED: status_counts[UNCHANGED],
+            SKIPPED: status_counts[SKIPPED],
+            "files": written,
+        }
+
+
+class ScanRequestHandler(BaseHTTPRequestHandler):
+    """"""
+
+    server: ScanServer
+
+    def do_GET(self) -> None:  # pylint: disable=C0103
+        """"""
+        self.handle_request({"/scan", "/prolog", "/status"})
+
+    def do_POST(self) -> None:  # pylint: disable=C0103
+        """"""
+        if self.headers.get(REQUEST_HEADER) is None:
+            self.send_json(HTTPStatus.FORBIDDEN, {"error": f"{REQUEST_HEADER} header is required"})
+            return
+        self.handle_request({"/update"})
+
+    def handle_request(self, routes: set) -> None:
+        """"""
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        path = query.get("path", [None])[0]
+        if url.path not in routes:
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": f"unknown request {url.path}"})
+            return
+
+        # Requests are served one at a time, so the warm state needs no locking
+        try:
+            if url.path == "/scan":
+                self.send_json(HTTPStatus.OK, self.server.scan(path))
+            elif url.path == "/status":
+                self.send_json(HTTPStatus.OK, self.get_status())
+            elif url.path == "/update":
+                dry_run = query.get("dry_run", ["0"])[0] not in ("0", "false")
+                self.send_json(HTTPStatus.OK, self.server.update(path, dry_run))
+            elif path is None:
+                self.send_json(HTTPStatus.BAD_REQUEST, {"error": "path is required"})
+            else:
+                prolog = self.server.render_prolog(path)
+                if prolog is None:
+                    self.send_json(HTTPStatus.NOT_FOUND, {"error": f"{path} has no prolog"})
+                else:
+                    self.send_text(HTTPStatus.OK, prolog)
+        except ValueError as error:
+            self.send_json(HTTPStatus.BAD_REQUEST, {"error": str(error)})
+        except (OSError, UnicodeDecodeError) as error:
+            self.send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(error)})
+
+    def get_status(self) -> dict:
+        """"""
+        watcher = self.server.watcher
+        return {
+            "project": str(self.server.folder_path),
+            "entity_files": len(watcher.entity_files),
+            "entities": len(watcher.entity_index),
+            "work_packages": len(watcher.work_packages),
+        }
+
+    def send_json(self, status: HTTPStatus, body) -> None:
+        """"""
+        self.send_body(status, json.dumps(body).encode("utf-8"), "application/json")
+
+    def send_text(self, status: HTTPStatus, body: str) -> None:
+        """"""
+        self.send_body(status, body.encode("utf-8"), "text/plain; charset=utf-8")
+
+    def send_body(self, status: HTTPStatus, body: bytes, content_type: str) -> None:
+        """"""
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)